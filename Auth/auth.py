@@ -1,58 +1,69 @@
-import os
-from jose import JWTError, jwt
-from datetime import datetime, timedelta
+import asyncio
+from jose import JWTError
+from datetime import timedelta
 from typing import Optional
-from dotenv import load_dotenv
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from database import db
 from schemas import TokenData, UserPublic
-from models import UserInDB
-from utils import generate_reset_token
-from email import send_password_reset_email
+from models import User
+from hashing import not_flagged, password_hasher
+from user_cache import user_cache
+from emails import send_password_reset_email
+from tokens import get_token_service
+from settings import get_settings
 
-# Load environment variables
-load_dotenv()
-
-# Configuration
-SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+settings = get_settings()
 
 # Security utilities
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt runs in hashing.password_hasher's process pool, awaiting it keeps the event loop free
+async def verify_password(plain_password, hashed_password, flagged=not_flagged):
+    return await password_hasher.verify(plain_password, hashed_password, flagged)
+
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def fetch_user(username: str):
+    """Read the user from the database and refresh the cache with it"""
+    generation = user_cache.generation()
+    user = await db.get_user(username)
+    if user is not None:
+        user_cache.set(username, user, generation)
+    return user
 
 async def get_user(username: str):
-    user_dict = await db.get_user(username)
-    if user_dict:
-        return UserInDB(**user_dict)
-    return None
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    return await fetch_user(username)
 
-async def authenticate_user(username: str, password: str):
-    user = await get_user(username)
+async def authenticate_user(username: str, password: str, flagged=not_flagged):
+    # never check a password against a cached hash, another worker may have changed it.
+    # the read is small next to the bcrypt verify.
+    user = await fetch_user(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password, flagged):
         return False
     return user
 
+def token_claims(user: User) -> dict:
+    """Claims identifying the user in an access token"""
+    claims = {"sub": user.username}
+    if settings.jwt_embed_user_claims:
+        claims.update({
+            "name": user.full_name,
+            "email": user.email,
+            "verified": user.verified,
+            "disabled": user.disabled,
+        })
+    return claims
+
+# Signing and verification live in the token service, keys are loaded once on first use
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    return get_token_service().encode(data, expires_delta or timedelta(minutes=15))
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
@@ -61,19 +72,28 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = get_token_service().decode(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
+    # stateless fast path, the token already carries everything the endpoints need
+    if settings.jwt_embed_user_claims and "verified" in payload:
+        return User(
+            username=token_data.username,
+            full_name=payload.get("name"),
+            email=payload.get("email"),
+            verified=payload.get("verified"),
+            disabled=payload.get("disabled"),
+        )
     user = await get_user(username=token_data.username)
     if user is None:
         raise credentials_exception
     return user
 
-async def get_current_active_user(current_user: UserInDB = Depends(get_current_user)):
+async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
     return UserPublic(
@@ -91,25 +111,33 @@ async def get_current_verified_user(current_user: UserPublic = Depends(get_curre
 
 async def request_password_reset(email: str) -> bool:
     """Request a password reset for the given email"""
-    user = await db.get_user_by_email(email)
-    if not user:
-        # Don't reveal that the email doesn't exist
-        return True
-    
-    reset_token = generate_reset_token()
-    success = await db.store_reset_token(email, reset_token)
+    # one call finds the user and stores a token made by the database, None just means no such email
+    reset_token = await db.store_reset_token(email)
     
-    if success:
-        # Send password reset email
+    if reset_token:
+        # Queue the password reset email, the outbox sends it in the background
         send_password_reset_email(email, reset_token)
     
-    return success
+    # Don't reveal whether the email exists
+    return True
 
 async def reset_password(reset_token: str, new_password: str) -> bool:
     """Reset a user's password using a reset token"""
-    user_id = await db.validate_reset_token(reset_token)
-    if not user_id:
+    # a bogus token must not cost a bcrypt hash. consume_password_reset checks the
+    # token again, so it still can't be used twice concurrently
+    if not await db.validate_reset_token(reset_token):
         return False
-    
-    hashed_password = get_password_hash(new_password)
-    return await db.update_password(user_id, hashed_password)
+    hashed_password = await get_password_hash(new_password)
+    return await db.reset_password(reset_token, hashed_password)
+
+async def sweep_expired_reset_tokens():
+    """Delete expired reset tokens in batches every PASSWORD_RESET_SWEEP_INTERVAL seconds"""
+    batch_size = settings.password_reset_sweep_batch
+    while True:
+        try:
+            # keep going while full batches come back, small batches keep each delete short
+            while await db.delete_expired_reset_tokens(batch_size) >= batch_size:
+                pass
+        except Exception as e:
+            print(f"Error sweeping expired reset tokens: {e}")
+        await asyncio.sleep(settings.password_reset_sweep_interval)
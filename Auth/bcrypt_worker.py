@@ -0,0 +1,31 @@
+"""bcrypt calls run by PasswordHasher's worker processes
+
+Spawned workers import this module and nothing else from the service, so it
+imports bcrypt only. Hashes are the same $2b$ format passlib produced, so
+existing passwords keep verifying.
+"""
+import bcrypt
+
+# bcrypt only looks at the first 72 bytes, passlib cut longer passwords the same way
+MAX_PASSWORD_BYTES = 72
+
+
+def _encode(password: str) -> bytes:
+    return password.encode("utf-8")[:MAX_PASSWORD_BYTES]
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt()).decode("ascii")
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return bcrypt.checkpw(_encode(plain_password), hashed_password.encode("ascii"))
+    except ValueError:
+        # not a bcrypt hash
+        return False
+
+
+def ready() -> bool:
+    """No-op sent once to each worker at start, so it is spawned and has bcrypt imported before the first login"""
+    return True
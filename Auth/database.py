@@ -1,40 +1,138 @@
-import os
-from dotenv import load_dotenv
-from supabase import create_client, Client
-from typing import Optional, Dict, List
+import re
+import httpx
+from datetime import datetime, timezone
+from typing import Any, Optional, Dict, List, Tuple, Type
 import uuid
+from pydantic import BaseModel
+from models import NewUser, UserInDB, UserRef
+from schemas import UserPublic
+from settings import get_settings
+from user_cache import user_cache
 
-# Load environment variables
-load_dotenv()
+settings = get_settings()
 
-# Initialize Supabase client
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
+Filters = List[Tuple[str, str]]
+
+# Postgres reports the violated key as: Key (email)=(a@b.com) already exists.
+DUPLICATE_KEY_DETAIL = re.compile(r"Key \((\w+)\)=")
+
+class DuplicateKeyError(Exception):
+    """A write violated a unique constraint, column names the conflicting key"""
+
+    def __init__(self, column: Optional[str]):
+        super().__init__(f"Duplicate value for {column}")
+        self.column = column
+
+def eq(value) -> str:
+    """PostgREST equality filter value"""
+    return f"eq.{value}"
+
+def columns(model: Type[BaseModel], exclude: Tuple[str, ...] = ()) -> str:
+    """PostgREST select list with exactly the fields of a model"""
+    return ",".join(name for name in model.model_fields if name not in exclude)
+
+# Projections per call site, rows only carry what the caller reads
+USER_IN_DB_COLUMNS = columns(UserInDB, exclude=("verification_code",))
+USER_PUBLIC_COLUMNS = columns(UserPublic)
+USER_REF_COLUMNS = columns(UserRef)
+NEW_USER_COLUMNS = columns(NewUser)
+
+
+class PostgrestClient:
+    """Async client for Supabase's PostgREST API over one pooled, keep-alive httpx client"""
+
+    def __init__(self, url: str, key: str):
+        self.url = f"{url.rstrip('/')}/rest/v1" if url else None
+        self.key = key
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created on first use so it binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                headers={
+                    "apikey": self.key,
+                    "Authorization": f"Bearer {self.key}",
+                },
+                limits=httpx.Limits(
+                    max_connections=settings.supabase_max_connections,
+                    max_keepalive_connections=settings.supabase_max_keepalive,
+                    keepalive_expiry=settings.supabase_keepalive_expiry,
+                ),
+                timeout=settings.supabase_timeout,
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method: str, path: str, params: Filters, json=None, prefer: Optional[str] = None) -> List[Dict]:
+        headers = {"Prefer": prefer} if prefer else None
+        response = await self.client.request(method, path, params=params, json=json, headers=headers)
+        if response.status_code == 409:
+            error = response.json()
+            if error.get("code") == "23505":
+                match = DUPLICATE_KEY_DETAIL.search(error.get("details") or "")
+                raise DuplicateKeyError(match.group(1) if match else None)
+        response.raise_for_status()
+        return response.json() if response.content else []
+
+    async def select(self, table: str, filters: Filters, columns: str = "*", limit: Optional[int] = None) -> List[Dict]:
+        params = [("select", columns), *filters]
+        if limit is not None:
+            params.append(("limit", str(limit)))
+        return await self._request("GET", f"/{table}", params)
+
+    async def insert(self, table: str, row: Dict, columns: str = "*") -> List[Dict]:
+        return await self._request("POST", f"/{table}", [("select", columns)], json=row, prefer="return=representation")
+
+    async def update(self, table: str, data: Dict, filters: Filters, columns: str = "*") -> List[Dict]:
+        return await self._request("PATCH", f"/{table}", [("select", columns), *filters], json=data, prefer="return=representation")
+
+    async def delete(self, table: str, filters: Filters) -> List[Dict]:
+        return await self._request("DELETE", f"/{table}", filters, prefer="return=minimal")
+
+    async def rpc(self, function: str, params: Dict) -> Any:
+        """Call a Postgres function, see sql/ for the ones this service defines"""
+        response = await self.client.post(f"/rpc/{function}", json=params)
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+
+# Initialize the PostgREST client
+postgrest = PostgrestClient(settings.supabase_url, settings.supabase_key)
 
 class SupabaseDB:
-    async def get_user(self, username: str) -> Optional[Dict]:
-        """Get a user by username from Supabase"""
-        response = supabase.table("users").select("*").eq("username", username).execute()
-        users = response.data
-        
+    def __init__(self, client: PostgrestClient):
+        self.client = client
+
+    async def close(self):
+        await self.client.close()
+
+    async def get_user(self, username: str) -> Optional[UserInDB]:
+        """Get a user by username from Supabase, with the fields needed to authenticate"""
+        users = await self.client.select("users", [("username", eq(username))], columns=USER_IN_DB_COLUMNS, limit=1)
+
         if not users or len(users) == 0:
             return None
-        
-        return users[0]
-    
-    async def get_user_by_email(self, email: str) -> Optional[Dict]:
-        """Get a user by email from Supabase"""
-        response = supabase.table("users").select("*").eq("email", email).execute()
-        users = response.data
-        
+
+        return UserInDB(**users[0])
+
+    async def get_user_by_email(self, email: str) -> Optional[UserRef]:
+        """Get the id and username of the user with this email from Supabase"""
+        users = await self.client.select("users", [("email", eq(email))], columns=USER_REF_COLUMNS, limit=1)
+
         if not users or len(users) == 0:
             return None
-        
-        return users[0]
-    
-    async def create_user(self, username: str, hashed_password: str, full_name: str, email: str) -> Dict:
-        """Create a new user in Supabase"""
+
+        return UserRef(**users[0])
+
+    async def create_user(self, username: str, hashed_password: str, full_name: str, email: str) -> NewUser:
+        """Create a new user in Supabase, raises DuplicateKeyError if the username or email is taken"""
         verification_code = str(uuid.uuid4())
         user_data = {
             "username": username,
@@ -45,61 +143,66 @@ class SupabaseDB:
             "verified": False,
             "verification_code": verification_code
         }
-        
-        response = supabase.table("users").insert(user_data).execute()
-        return response.data[0]
-    
-    async def update_user(self, username: str, data: Dict) -> Optional[Dict]:
+
+        users = await self.client.insert("users", user_data, columns=NEW_USER_COLUMNS)
+        return NewUser(**users[0])
+
+    async def update_user(self, username: str, data: Dict) -> Optional[UserPublic]:
         """Update user data in Supabase"""
-        response = supabase.table("users").update(data).eq("username", username).execute()
-        if not response.data:
+        users = await self.client.update("users", data, [("username", eq(username))], columns=USER_PUBLIC_COLUMNS)
+        user_cache.invalidate(username)
+        if not users:
             return None
-        return response.data[0]
-    
+        return UserPublic(**users[0])
+
     async def verify_user(self, verification_code: str) -> bool:
         """Verify a user's email using verification code"""
-        response = supabase.table("users").select("*").eq("verification_code", verification_code).execute()
-        users = response.data
-        
-        if not users or len(users) == 0:
-            return False
-        
-        user = users[0]
-        update_response = supabase.table("users").update({"verified": True}).eq("id", user["id"]).execute()
-        
-        return bool(update_response.data)
-    
-    async def store_reset_token(self, email: str, reset_token: str) -> bool:
-        """Store a password reset token for a user"""
-        user = await self.get_user_by_email(email)
-        if not user:
-            return False
-        
-        response = supabase.table("password_resets").insert({
-            "user_id": user["id"],
-            "reset_token": reset_token,
-            "expires_at": "NOW() + interval '1 hour'"
-        }).execute()
-        
-        return bool(response.data)
-    
+        users = await self.client.update(
+            "users", {"verified": True}, [("verification_code", eq(verification_code))], columns="username"
+        )
+        for user in users:
+            user_cache.invalidate(user["username"])
+
+        return bool(users)
+
+    async def store_reset_token(self, email: str) -> Optional[str]:
+        """Create a password reset token for the user with this email, None if there is none"""
+        # the token and expiry are generated in SQL, callers can't pick them
+        return await self.client.rpc("create_password_reset", {
+            "p_email": email,
+            "p_ttl_minutes": settings.password_reset_ttl_minutes,
+        })
+
     async def validate_reset_token(self, reset_token: str) -> Optional[str]:
         """Validate a password reset token and return the associated user ID"""
-        response = supabase.table("password_resets").select("user_id").eq("reset_token", reset_token).gte("expires_at", "NOW()").execute()
-        
-        if not response.data or len(response.data) == 0:
+        resets = await self.client.select(
+            "password_resets",
+            [("reset_token", eq(reset_token)), ("expires_at", f"gt.{datetime.now(timezone.utc).isoformat()}")],
+            columns="user_id",
+            limit=1,
+        )
+
+        if not resets or len(resets) == 0:
             return None
-        
-        return response.data[0]["user_id"]
-    
-    async def update_password(self, user_id: str, hashed_password: str) -> bool:
-        """Update a user's password by user ID"""
-        response = supabase.table("users").update({"hashed_password": hashed_password}).eq("id", user_id).execute()
-        
-        # Delete all reset tokens for this user
-        supabase.table("password_resets").delete().eq("user_id", user_id).execute()
-        
-        return bool(response.data)
+
+        return resets[0]["user_id"]
+
+    async def reset_password(self, reset_token: str, hashed_password: str) -> bool:
+        """Set the password of the token's user and delete all their reset tokens, in one call"""
+        # the function re-checks the token, so a token can't be used twice concurrently
+        username = await self.client.rpc("consume_password_reset", {
+            "p_reset_token": reset_token,
+            "p_hashed_password": hashed_password,
+        })
+        if not username:
+            return False
+
+        user_cache.invalidate(username)
+        return True
+
+    async def delete_expired_reset_tokens(self, batch_size: int) -> int:
+        """Delete up to batch_size expired reset tokens, returns how many were deleted"""
+        return await self.client.rpc("delete_expired_password_resets", {"p_batch_size": batch_size}) or 0
 
 # Create a database instance
-db = SupabaseDB()
+db = SupabaseDB(postgrest)
@@ -1,39 +1,24 @@
-import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from dotenv import load_dotenv
+from outbox import EmailOutbox, SMTPConnection
+from settings import get_settings
 
-load_dotenv()
+settings = get_settings()
 
-# Email configuration
-SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-SMTP_USERNAME = os.getenv("SMTP_USERNAME")
-SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-FROM_EMAIL = os.getenv("FROM_EMAIL")
+def smtp_connection() -> SMTPConnection:
+    return SMTPConnection(settings.smtp_server, settings.smtp_port, settings.smtp_username, settings.smtp_password,
+                          settings.from_email, settings.smtp_starttls, settings.smtp_idle_timeout)
 
-def send_email(to_email: str, subject: str, html_content: str) -> bool:
-    """Send an email using the configured SMTP server"""
-    try:
-        message = MIMEMultipart("alternative")
-        message["Subject"] = subject
-        message["From"] = FROM_EMAIL
-        message["To"] = to_email
-
-        html_part = MIMEText(html_content, "html")
-        message.attach(html_part)
+# No connection is opened until the lifespan starts the outbox workers
+outbox = EmailOutbox(
+    smtp_connection,
+    workers=settings.email_workers,
+    max_queue=settings.email_max_queue,
+    max_attempts=settings.email_max_attempts,
+    retry_backoff=settings.email_retry_backoff,
+)
 
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.ehlo()
-            server.starttls()
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.sendmail(FROM_EMAIL, to_email, message.as_string())
-        
-        return True
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        return False
+def send_email(to_email: str, subject: str, html_content: str) -> bool:
+    """Queue an email for delivery by the outbox workers"""
+    return outbox.enqueue(to_email, subject, html_content)
 
 def send_verification_email(to_email: str, verification_code: str) -> bool:
     """Send an email verification email"""
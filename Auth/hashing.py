@@ -0,0 +1,143 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
+from fastapi import HTTPException, status
+# the functions sent to the worker processes live in a module that imports
+# only bcrypt, so spawned workers don't re-import fastapi and the settings
+from bcrypt_worker import hash_password, ready, verify_password
+from settings import get_settings
+
+
+def not_flagged() -> bool:
+    return False
+
+
+def _busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry",
+        headers={"Retry-After": "1"},
+    )
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool so hashing never blocks the event loop
+
+    Jobs can be flagged, e.g. logins from clients that keep failing. Flagged jobs
+    may only take max_pending - reserved slots and all workers but one, unflagged
+    ones are handed to a worker first, and a full queue makes room for an
+    unflagged job by dropping a flagged one. flagged is a callable, checked again
+    whenever a worker frees up, so a job whose client turns out to be flooding
+    moves to the back.
+    """
+
+    def __init__(self, workers: int, max_pending: int, reserved: int = 0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.reserved = reserved
+        self.pending = 0
+        self.evicted = 0
+        # flagged jobs leave one worker free for the others
+        self.flagged_workers = max(workers - 1, 1)
+        self._running = 0
+        self._running_flagged = 0
+        # jobs waiting for one of the workers, with their flagged check
+        self._waiting: List[Tuple[Callable[[], bool], asyncio.Future]] = []
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self._executor is None:
+            # spawn instead of fork: the parent has an event loop and threads running
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            # processes are only spawned for submitted work, one no-op per worker
+            # brings them all up now instead of during the first logins
+            for _ in range(self.workers):
+                self._executor.submit(ready)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _evict(self) -> bool:
+        # the newest flagged job still waiting gives up its place
+        for i in range(len(self._waiting) - 1, -1, -1):
+            flagged, future = self._waiting[i]
+            if flagged():
+                del self._waiting[i]
+                future.set_exception(_busy())
+                self.evicted += 1
+                return True
+        return False
+
+    async def _acquire(self, flagged: Callable[[], bool]) -> bool:
+        """Wait for a worker, returns whether the job got it as a flagged one"""
+        future = asyncio.get_running_loop().create_future()
+        entry = (flagged, future)
+        self._waiting.append(entry)
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # the worker was already handed to us
+                self._release(future.result())
+            elif entry in self._waiting:
+                self._waiting.remove(entry)
+            raise
+
+    def _dispatch(self):
+        # free workers go to the oldest unflagged job, else the oldest flagged one,
+        # but flagged jobs never hold every worker
+        while self._running < self.workers and self._waiting:
+            index = next((i for i, (flagged, _) in enumerate(self._waiting) if not flagged()), None)
+            as_flagged = index is None
+            if as_flagged:
+                if self._running_flagged >= self.flagged_workers:
+                    return
+                index = 0
+            _, future = self._waiting.pop(index)
+            if future.done():
+                continue
+            self._running += 1
+            self._running_flagged += as_flagged
+            future.set_result(as_flagged)
+
+    def _release(self, as_flagged: bool):
+        self._running -= 1
+        self._running_flagged -= as_flagged
+        self._dispatch()
+
+    async def _run(self, func, *args, flagged: Callable[[], bool] = not_flagged):
+        # fail fast instead of queueing without bound during a login storm
+        if self.pending >= self.max_pending - (self.reserved if flagged() else 0):
+            if flagged() or not self._evict():
+                raise _busy()
+        self.start()
+        self.pending += 1
+        try:
+            as_flagged = await self._acquire(flagged)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+            finally:
+                self._release(as_flagged)
+        finally:
+            self.pending -= 1
+
+    async def verify(self, plain_password: str, hashed_password: str,
+                     flagged: Callable[[], bool] = not_flagged) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password, flagged=flagged)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+
+# bcrypt is CPU bound, one worker process per core by default, and
+# PASSWORD_HASH_MAX_PENDING hashes in flight (running + queued) before requests get a 503.
+# PASSWORD_HASH_RESERVED of those are kept for clients that aren't flagged
+password_hasher = PasswordHasher(get_settings().password_hash_workers, get_settings().password_hash_max_pending,
+                                 get_settings().password_hash_reserved)
@@ -0,0 +1,106 @@
+"""Login latency under a credential-stuffing flood: python load_test_login.py
+
+Runs the app in process against postgrest_stub.py. A flood of wrong-password
+logins is spread over --ips client IPs and --usernames accounts, while one
+legitimate user logs in --logins times, each time from a fresh IP the way
+separate real users would. Its latency and failures are reported before and
+during the flood, with how the flood was answered (429 = rejected by the rate
+limiter, 401 = cost a bcrypt verify, 503 = no room left in the hasher for a
+flagged client).
+
+Compare with the limiter off (--no-limit), and with the shared windows by
+running it with LOGIN_RATE_LIMIT_BACKEND=redis.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from collections import Counter
+from typing import List
+
+# no real Supabase or SMTP needed, anything already set in the environment wins
+for name, value in {
+    "SUPABASE_URL": "http://stub",
+    "SUPABASE_KEY": "stub",
+    "JWT_SECRET_KEY": "load-test-secret-key-0123456789abcdef",
+    "SMTP_SERVER": "127.0.0.1",
+    "SMTP_PORT": "1",
+    "SMTP_STARTTLS": "false",
+    "EMAIL_MAX_ATTEMPTS": "1",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+def _ms(samples: List[float]) -> str:
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"p50 {statistics.median(samples) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, max {samples[-1] * 1000:.0f} ms"
+
+
+async def run(args):
+    import httpx
+    import database
+    import main
+    import postgrest_stub
+    from rate_limit import login_rate_limiter
+
+    if args.no_limit:
+        login_rate_limiter.per_user = login_rate_limiter.per_ip = 10 ** 9
+
+    database.postgrest._client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=postgrest_stub.app), base_url="http://stub/rest/v1"
+    )
+
+    def client(ip: str):
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app, client=(ip, 40000)),
+                                 base_url="http://auth", timeout=None)
+
+    async def login(http, username: str, password: str):
+        start = time.perf_counter()
+        response = await http.post("/token", data={"username": username, "password": password})
+        return response.status_code, time.perf_counter() - start
+
+    async with main.lifespan(main.app):
+        legit = client("10.0.0.1")
+        # one IP per legitimate login, so the measurement itself never hits the per-IP limit
+        legit_ips = [client(f"10.0.{i // 250}.{i % 250 + 1}") for i in range(2 * args.logins)]
+        attackers = [client(f"203.0.113.{i % 250}") if i < 250 else client(f"198.51.{i // 250}.{i % 250}")
+                     for i in range(args.ips)]
+        users = [f"victim{i}" for i in range(args.usernames)]
+        for username in ["alice", *users]:
+            await legit.post("/register", json={"username": username, "full_name": username,
+                                                "email": f"{username}@example.com", "password": "correct-horse"})
+
+        async def legit_logins(ips):
+            samples, failures = [], Counter()
+            for http in ips:
+                code, elapsed = await login(http, "alice", "correct-horse")
+                samples.append(elapsed)
+                if code != 200:
+                    failures[code] += 1
+            return samples, failures
+
+        baseline, baseline_failures = await legit_logins(legit_ips[:args.logins])
+        flood = asyncio.gather(*(login(attackers[i % args.ips], users[i % args.usernames], f"guess{i}")
+                                 for i in range(args.attempts)))
+        # let the flood queue up before measuring
+        await asyncio.sleep(0.05)
+        during, during_failures = await legit_logins(legit_ips[args.logins:])
+        answers = Counter(code for code, _ in await flood)
+
+    limits = "off" if args.no_limit else f"{login_rate_limiter.per_user}/user, {login_rate_limiter.per_ip}/ip"
+    print(f"{args.attempts} bad logins from {args.ips} IPs on {args.usernames} accounts, limits {limits}")
+    print(f"legit before flood: {_ms(baseline)}, failed {dict(baseline_failures)}")
+    print(f"legit during flood: {_ms(during)}, failed {dict(during_failures)}")
+    print(f"flood answers: {dict(sorted(answers.items()))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--attempts", type=int, default=1000, help="wrong-password logins in the flood")
+    parser.add_argument("--ips", type=int, default=20, help="client IPs the flood comes from")
+    parser.add_argument("--usernames", type=int, default=20, help="accounts the flood targets")
+    parser.add_argument("--logins", type=int, default=20, help="legitimate logins measured before and during")
+    parser.add_argument("--no-limit", action="store_true", help="disable the rate limiter for comparison")
+    asyncio.run(run(parser.parse_args()))
@@ -1,16 +1,46 @@
-from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager, suppress
 from datetime import timedelta
 from typing import List
+import asyncio
 
 import auth
 from schemas import Token, UserCreate, UserPublic, EmailVerification, PasswordResetRequest, PasswordReset, ChangePassword, UserUpdate
-from database import db
-from email import send_verification_email
+from database import db, DuplicateKeyError
+from hashing import password_hasher
+from emails import send_verification_email, outbox
+from utils import generate_verification_code
+from tokens import get_token_service
+from rate_limit import login_rate_limiter
+from settings import get_settings
+
+settings = get_settings()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Clients and keys are built here, not at import, so importing the app stays cheap.
+    # Spawn the bcrypt workers now, they finish booting while the rest of startup runs,
+    # instead of during the first logins.
+    password_hasher.start()
+    get_token_service()
+    login_rate_limiter.start()
+    outbox.start()
+    sweeper = asyncio.create_task(auth.sweep_expired_reset_tokens())
+    yield
+    sweeper.cancel()
+    with suppress(asyncio.CancelledError):
+        await sweeper
+    # let queued emails go out before the SMTP connections close
+    await outbox.stop()
+    password_hasher.shutdown()
+    await login_rate_limiter.close()
+    # close the pooled keep-alive connections to Supabase
+    await db.close()
 
 # Initialize FastAPI app
-app = FastAPI(title="FastAPI Login/Signup System with Supabase")
+app = FastAPI(title="FastAPI Login/Signup System with Supabase", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -23,59 +53,54 @@ app.add_middleware(
 
 # Authentication endpoints
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = await auth.authenticate_user(form_data.username, form_data.password)
+async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    # reject floods before they cost a bcrypt verify
+    ip = request.client.host if request.client else None
+    await login_rate_limiter.check(form_data.username, ip)
+    # clients that keep failing only get the hasher capacity others leave free
+    async with login_rate_limiter.verifying(form_data.username, ip) as flagged:
+        user = await auth.authenticate_user(form_data.username, form_data.password, flagged)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
+    await login_rate_limiter.reset(user.username)
+    access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
     access_token = auth.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data=auth.token_claims(user), expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 # User registration and profile
 @app.post("/register", response_model=UserPublic)
-async def register_user(background_tasks: BackgroundTasks, user_data: UserCreate):
-    # Check if user already exists
-    if await db.get_user(user_data.username):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username already registered"
+async def register_user(user_data: UserCreate):
+    # Create new user, the unique constraints on username and email reject duplicates
+    # in the same round trip instead of checking for each one first
+    hashed_password = await auth.get_password_hash(user_data.password)
+    try:
+        user = await db.create_user(
+            user_data.username,
+            hashed_password,
+            user_data.full_name,
+            user_data.email
         )
-    
-    # Check if email already exists
-    if await db.get_user_by_email(user_data.email):
+    except DuplicateKeyError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already registered"
+            detail="Email already registered" if e.column == "email" else "Username already registered"
         )
     
-    # Create new user
-    hashed_password = auth.get_password_hash(user_data.password)
-    user = await db.create_user(
-        user_data.username,
-        hashed_password,
-        user_data.full_name,
-        user_data.email
-    )
-    
-    # Send verification email in the background
-    background_tasks.add_task(
-        send_verification_email,
-        user_data.email,
-        user["verification_code"]
-    )
+    # Queue the verification email, the outbox sends it in the background
+    send_verification_email(user_data.email, user.verification_code)
     
     return UserPublic(
-        username=user["username"],
-        full_name=user["full_name"],
-        email=user["email"],
-        verified=user["verified"],
-        disabled=user["disabled"]
+        username=user.username,
+        full_name=user.full_name,
+        email=user.email,
+        verified=user.verified,
+        disabled=user.disabled
     )
 
 @app.get("/users/me", response_model=UserPublic)
@@ -96,22 +121,20 @@ async def update_user_profile(
         )
     
     # If email is being updated, set verified to False and generate new verification code
-    if "email" in update_data and update_data["email"] != current_user.email:
-        # Check if email already exists
-        if await db.get_user_by_email(update_data["email"]):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered"
-            )
-        
-        verification_code = auth.generate_verification_code()
+    email_changed = "email" in update_data and update_data["email"] != current_user.email
+    if email_changed:
         update_data["verified"] = False
-        update_data["verification_code"] = verification_code
-        
-        # Send verification email
-        send_verification_email(update_data["email"], verification_code)
+        update_data["verification_code"] = generate_verification_code()
     
-    updated_user = await db.update_user(current_user.username, update_data)
+    # the unique constraint on email rejects a taken address, even one claimed
+    # by a concurrent request, instead of checking for it first
+    try:
+        updated_user = await db.update_user(current_user.username, update_data)
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
     
     if not updated_user:
         raise HTTPException(
@@ -119,13 +142,11 @@ async def update_user_profile(
             detail="Failed to update user profile"
         )
     
-    return UserPublic(
-        username=updated_user["username"],
-        full_name=updated_user["full_name"],
-        email=updated_user["email"],
-        verified=updated_user["verified"],
-        disabled=updated_user["disabled"]
-    )
+    if email_changed:
+        # Queue the verification email instead of waiting for SMTP in the request
+        send_verification_email(update_data["email"], update_data["verification_code"])
+    
+    return updated_user
 
 @app.post("/verify-email", response_model=dict)
 async def verify_email(verification_data: EmailVerification):
@@ -163,16 +184,16 @@ async def change_password(
     password_data: ChangePassword,
     current_user: UserPublic = Depends(auth.get_current_verified_user)
 ):
-    # Verify current password
-    user = await auth.get_user(current_user.username)
-    if not auth.verify_password(password_data.current_password, user.hashed_password):
+    # Verify current password, against the stored hash rather than a cached one
+    user = await auth.fetch_user(current_user.username)
+    if not await auth.verify_password(password_data.current_password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Current password is incorrect"
         )
     
     # Update password
-    hashed_password = auth.get_password_hash(password_data.new_password)
+    hashed_password = await auth.get_password_hash(password_data.new_password)
     success = await db.update_user(current_user.username, {"hashed_password": hashed_password})
     
     if not success:
@@ -189,4 +210,23 @@ async def protected_resource(current_user: UserPublic = Depends(auth.get_current
     return {
         "message": f"Hello, {current_user.full_name}! This is a protected resource.",
         "data": "This data is only visible to verified users."
-    }
\ No newline at end of file
+    }
+
+# Email outbox metrics
+@app.get("/metrics/email-outbox")
+async def email_outbox_metrics():
+    return outbox.stats()
+
+# Public signing key so other services can verify tokens locally (RS256 and friends)
+@app.get("/.well-known/jwks.json")
+async def jwks():
+    return get_token_service().public_jwks()
+
+if __name__ == "__main__":
+    import sys
+    if "--profile-startup" in sys.argv:
+        import startup_profile
+        startup_profile.report("main")
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -12,4 +12,12 @@ class User(BaseModel):
 
 class UserInDB(User):
     hashed_password: str
-    verification_code: Optional[str] = None
\ No newline at end of file
+    verification_code: Optional[str] = None
+
+class NewUser(User):
+    verification_code: str
+
+class UserRef(BaseModel):
+    """Identifying columns of a user row, for lookups that only need to know who"""
+    id: str
+    username: str
@@ -0,0 +1,222 @@
+import asyncio
+import smtplib
+import time
+from dataclasses import dataclass
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class OutgoingEmail:
+    to_email: str
+    subject: str
+    html_content: str
+    attempts: int = 0
+
+
+class SMTPConnection:
+    """One authenticated SMTP session, reopened when it has been idle too long or breaks"""
+
+    def __init__(self, host: str, port: int, username: Optional[str], password: Optional[str],
+                 from_email: str, starttls: bool, idle_timeout: float):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.from_email = from_email
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.username:
+            server.login(self.username, self.password)
+        self._server = server
+
+    def _alive(self) -> bool:
+        if self._server is None:
+            return False
+        # servers drop idle sessions, probe before reusing an old one
+        if time.monotonic() - self._last_used > self.idle_timeout:
+            try:
+                return self._server.noop()[0] == 250
+            except smtplib.SMTPException:
+                return False
+            except OSError:
+                return False
+        return True
+
+    def send(self, email: OutgoingEmail):
+        message = MIMEMultipart("alternative")
+        message["Subject"] = email.subject
+        message["From"] = self.from_email
+        message["To"] = email.to_email
+        message.attach(MIMEText(email.html_content, "html"))
+
+        if not self._alive():
+            self.close()
+            self._connect()
+        try:
+            self._server.sendmail(self.from_email, email.to_email, message.as_string())
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # the session can't be trusted anymore, the retry opens a new one
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    @property
+    def connected(self) -> bool:
+        return self._server is not None
+
+
+class EmailOutbox:
+    """Async email queue drained by a few workers, each reusing one SMTP connection
+
+    Failed sends are retried with exponential backoff. smtplib is blocking,
+    so every SMTP call runs in a thread and the event loop never waits on it.
+    stop() sends retries that are still waiting right away instead of losing
+    them, and counts whatever it can't send in time as abandoned.
+    """
+
+    def __init__(self, connection_factory, workers: int = 2, max_queue: int = 10000,
+                 max_attempts: int = 5, retry_backoff: float = 1.0, max_backoff: float = 60.0):
+        self.connection_factory = connection_factory
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.queue: "asyncio.Queue[OutgoingEmail]" = asyncio.Queue(maxsize=max_queue)
+        self._tasks: List[asyncio.Task] = []
+        self._connections: List[SMTPConnection] = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.abandoned = 0
+        self.in_flight = 0
+        # emails waiting out their backoff, by id(email)
+        self._retries: Dict[int, Tuple[asyncio.TimerHandle, OutgoingEmail]] = {}
+
+    def start(self):
+        if self._tasks:
+            return
+        for _ in range(self.workers):
+            connection = self.connection_factory()
+            self._connections.append(connection)
+            self._tasks.append(asyncio.create_task(self._worker(connection)))
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Give queued and retrying emails a chance to go out, then stop the workers and close the connections"""
+        if self._tasks:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + drain_timeout
+            while True:
+                # don't wait out the backoff, the timers won't fire after shutdown
+                self._flush_retries()
+                try:
+                    await asyncio.wait_for(self.queue.join(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                # sends that failed again while draining were scheduled for another retry
+                if not self._retries:
+                    break
+            abandoned = self.queue.qsize() + len(self._retries)
+            if abandoned:
+                self.abandoned += abandoned
+                print(f"Email outbox stopped with {abandoned} emails unsent")
+            for handle, _ in self._retries.values():
+                handle.cancel()
+            self._retries = {}
+        for task in self._tasks:
+            task.cancel()
+        # workers return only once their current send is done
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for connection in self._connections:
+            await asyncio.to_thread(connection.close)
+        self._connections = []
+
+    def enqueue(self, to_email: str, subject: str, html_content: str) -> bool:
+        """Queue an email without waiting for SMTP, False if the outbox is full"""
+        try:
+            self.queue.put_nowait(OutgoingEmail(to_email, subject, html_content))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"Email outbox full, dropping email to {to_email}")
+            return False
+        return True
+
+    def _retry(self, email: OutgoingEmail):
+        self._retries.pop(id(email), None)
+        try:
+            self.queue.put_nowait(email)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _flush_retries(self):
+        for handle, email in list(self._retries.values()):
+            handle.cancel()
+            self._retry(email)
+
+    async def _worker(self, connection: SMTPConnection):
+        loop = asyncio.get_running_loop()
+        while True:
+            email = await self.queue.get()
+            self.in_flight += 1
+            try:
+                email.attempts += 1
+                send = asyncio.ensure_future(asyncio.to_thread(connection.send, email))
+                try:
+                    await asyncio.shield(send)
+                except asyncio.CancelledError:
+                    # the thread can't be interrupted, let it finish so stop()
+                    # doesn't close the connection while it is still sending
+                    await asyncio.wait([send])
+                    if send.exception() is None:
+                        self.sent += 1
+                    else:
+                        self.abandoned += 1
+                    raise
+                self.sent += 1
+            except Exception as e:
+                permanent = isinstance(e, smtplib.SMTPRecipientsRefused)
+                if permanent or email.attempts >= self.max_attempts:
+                    self.failed += 1
+                    print(f"Error sending email to {email.to_email}: {e}")
+                else:
+                    # retry later without holding up this worker
+                    self.retried += 1
+                    delay = min(self.retry_backoff * 2 ** (email.attempts - 1), self.max_backoff)
+                    self._retries[id(email)] = (loop.call_later(delay, self._retry, email), email)
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "in_flight": self.in_flight,
+            "retry_scheduled": len(self._retries),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "abandoned": self.abandoned,
+            "workers": len(self._tasks),
+            "open_connections": sum(connection.connected for connection in self._connections),
+        }
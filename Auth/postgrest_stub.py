@@ -0,0 +1,201 @@
+"""Local stand-in for Supabase's PostgREST API
+
+Implements the subset of PostgREST the Auth service uses (select, insert,
+update, delete with simple filters, and the functions in sql/) over
+in-memory tables, so the service
+can be run and load tested without a live Supabase project:
+
+    uvicorn postgrest_stub:app --port 54321
+    SUPABASE_URL=http://localhost:54321 SUPABASE_KEY=stub uvicorn main:app
+"""
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="PostgREST stand-in")
+
+# unique columns per table, enforced like the real constraints
+UNIQUE = {
+    "users": ["id", "username", "email"],
+    "password_resets": ["id", "reset_token"],
+}
+
+tables: Dict[str, List[Dict]] = {table: [] for table in UNIQUE}
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _coerce(raw: str, current):
+    if raw.lower() in ("now()", "now"):
+        return now()
+    if isinstance(current, bool):
+        return raw.lower() == "true"
+    if isinstance(current, (int, float)):
+        return type(current)(raw)
+    return raw
+
+
+OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+}
+
+
+def _matches(row: Dict, filters: List) -> bool:
+    for column, op, raw in filters:
+        value = row.get(column)
+        if op == "is":
+            expected = {"null": None, "true": True, "false": False}[raw.lower()]
+            if value is not expected:
+                return False
+        elif not OPERATORS[op](value, _coerce(raw, value)):
+            return False
+    return True
+
+
+def _parse(request: Request):
+    filters = []
+    columns = "*"
+    limit = None
+    for key, value in request.query_params.multi_items():
+        if key == "select":
+            columns = value
+        elif key == "limit":
+            limit = int(value)
+        elif key not in ("order", "offset", "on_conflict"):
+            op, _, raw = value.partition(".")
+            filters.append((key, op, raw))
+    return filters, columns, limit
+
+
+def _project(row: Dict, columns: str) -> Dict:
+    if columns == "*":
+        return dict(row)
+    return {column: row.get(column) for column in columns.split(",")}
+
+
+def _conflict(table: str, row: Dict, ignore: Dict = None):
+    for column in UNIQUE.get(table, []):
+        if row.get(column) is None:
+            continue
+        for other in tables[table]:
+            if other is not ignore and other.get(column) == row[column]:
+                return JSONResponse(status_code=409, content={
+                    "code": "23505",
+                    "details": f"Key ({column})=({row[column]}) already exists.",
+                    "hint": None,
+                    "message": f'duplicate key value violates unique constraint "{table}_{column}_key"',
+                })
+    return None
+
+
+def _represent(request: Request, rows: List[Dict], columns: str, status_code: int):
+    if "return=representation" in request.headers.get("prefer", ""):
+        return JSONResponse(status_code=status_code, content=[_project(row, columns) for row in rows])
+    return Response(status_code=204 if status_code == 200 else status_code)
+
+
+@app.get("/rest/v1/{table}")
+async def select(table: str, request: Request):
+    filters, columns, limit = _parse(request)
+    rows = [_project(row, columns) for row in tables[table] if _matches(row, filters)]
+    return rows[:limit] if limit is not None else rows
+
+
+@app.post("/rest/v1/{table}")
+async def insert(table: str, request: Request):
+    _, columns, _ = _parse(request)
+    payload = await request.json()
+    inserted = []
+    for item in payload if isinstance(payload, list) else [payload]:
+        row = {"id": str(uuid.uuid4()), "created_at": now(), **item}
+        if table == "users":
+            row.setdefault("disabled", False)
+            row.setdefault("verified", False)
+        conflict = _conflict(table, row)
+        if conflict is not None:
+            return conflict
+        tables[table].append(row)
+        inserted.append(row)
+    return _represent(request, inserted, columns, 201)
+
+
+@app.patch("/rest/v1/{table}")
+async def update(table: str, request: Request):
+    filters, columns, _ = _parse(request)
+    data = await request.json()
+    updated = []
+    for row in tables[table]:
+        if _matches(row, filters):
+            conflict = _conflict(table, {**row, **data}, ignore=row)
+            if conflict is not None:
+                return conflict
+            row.update(data)
+            updated.append(row)
+    return _represent(request, updated, columns, 200)
+
+
+@app.delete("/rest/v1/{table}")
+async def delete(table: str, request: Request):
+    filters, columns, _ = _parse(request)
+    deleted = [row for row in tables[table] if _matches(row, filters)]
+    tables[table] = [row for row in tables[table] if not _matches(row, filters)]
+    return _represent(request, deleted, columns, 200)
+
+
+# Python versions of the functions in sql/password_resets.sql
+def create_password_reset(p_email: str, p_ttl_minutes: int):
+    users = [user for user in tables["users"] if user["email"] == p_email]
+    if not users:
+        return None
+    reset_token = secrets.token_hex(32)
+    expires_at = datetime.now(timezone.utc) + timedelta(minutes=min(max(p_ttl_minutes, 1), 1440))
+    for user in users:
+        tables["password_resets"].append({"id": str(uuid.uuid4()), "created_at": now(), "user_id": user["id"],
+                                          "reset_token": reset_token, "expires_at": expires_at.isoformat()})
+    return reset_token
+
+
+def consume_password_reset(p_reset_token: str, p_hashed_password: str):
+    current = now()
+    reset = next((row for row in tables["password_resets"]
+                  if row["reset_token"] == p_reset_token and row["expires_at"] > current), None)
+    if reset is None:
+        return None
+    user = next((user for user in tables["users"] if user["id"] == reset["user_id"]), None)
+    tables["password_resets"] = [row for row in tables["password_resets"] if row["user_id"] != reset["user_id"]]
+    if user is None:
+        return None
+    user["hashed_password"] = p_hashed_password
+    return user["username"]
+
+
+def delete_expired_password_resets(p_batch_size: int):
+    current = now()
+    expired = {row["id"] for row in tables["password_resets"] if row["expires_at"] <= current}
+    expired = set(list(expired)[:p_batch_size])
+    tables["password_resets"] = [row for row in tables["password_resets"] if row["id"] not in expired]
+    return len(expired)
+
+
+FUNCTIONS = {
+    "create_password_reset": create_password_reset,
+    "consume_password_reset": consume_password_reset,
+    "delete_expired_password_resets": delete_expired_password_resets,
+}
+
+
+@app.post("/rest/v1/rpc/{function}")
+async def rpc(function: str, request: Request):
+    if function not in FUNCTIONS:
+        return JSONResponse(status_code=404, content={"code": "PGRST202", "message": f"Could not find the function {function}"})
+    return FUNCTIONS[function](**await request.json())
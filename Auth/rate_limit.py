@@ -0,0 +1,224 @@
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+from fastapi import HTTPException, status
+from settings import get_settings
+
+
+class MemoryRateLimiter:
+    """Sliding-window log of attempt times per key, kept in this process"""
+
+    max_keys = 100000
+
+    def __init__(self):
+        self._hits: Dict[str, deque] = {}
+
+    def _sweep(self, now: float, window: float):
+        # forget keys that have been quiet for a whole window
+        for key in [key for key, hits in self._hits.items() if not hits or hits[-1] <= now - window]:
+            del self._hits[key]
+
+    async def hit(self, keys: List[str], limits: List[int], window: float) -> Tuple[float, int]:
+        """Record an attempt on every key, or return the seconds until one is allowed,
+        with the most attempts any key already had in the window"""
+        now = time.monotonic()
+        if len(self._hits) > self.max_keys:
+            self._sweep(now, window)
+        retry_after = 0.0
+        prior = 0
+        for key, limit in zip(keys, limits):
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            prior = max(prior, len(hits))
+            if len(hits) >= limit:
+                retry_after = max(retry_after, hits[0] + window - now)
+        if retry_after:
+            return retry_after, prior
+        for key in keys:
+            self._hits[key].append(now)
+        return 0.0, prior
+
+    async def reset(self, key: str):
+        self._hits.pop(key, None)
+
+    async def close(self):
+        pass
+
+
+# Checks every window and records the attempt only if all of them have room.
+# returns the seconds to wait (0 when recorded) and the most attempts a key already had
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local retry_after = 0
+local prior = 0
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    local count = redis.call('ZCARD', key)
+    prior = math.max(prior, count)
+    if count >= tonumber(ARGV[3 + i]) then
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        retry_after = math.max(retry_after, tonumber(oldest[2]) + window - now)
+    end
+end
+if retry_after > 0 then
+    return {tostring(retry_after), prior}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[3])
+    redis.call('PEXPIRE', key, math.ceil(window * 1000))
+end
+return {'0', prior}
+"""
+
+
+class RedisRateLimiter:
+    """Sliding-window log in Redis sorted sets, shared by every worker"""
+
+    def __init__(self, host: str, port: int, db: int, max_connections: int):
+        import redis.asyncio as redis
+
+        # bursts wait for a pooled connection instead of failing (and failing open)
+        pool = redis.BlockingConnectionPool(
+            host=host, port=port, db=db, max_connections=max_connections, timeout=5, decode_responses=True
+        )
+        self.redis_client = redis.Redis(connection_pool=pool)
+        self._script = self.redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+
+    async def hit(self, keys: List[str], limits: List[int], window: float) -> Tuple[float, int]:
+        """Record an attempt on every key, or return the seconds until one is allowed,
+        with the most attempts any key already had in the window"""
+        # one round trip, the check and the insert can't interleave with other workers
+        retry_after, prior = await self._script(keys=keys, args=[time.time(), window, uuid.uuid4().hex, *limits])
+        return float(retry_after), int(prior)
+
+    async def reset(self, key: str):
+        await self.redis_client.delete(key)
+
+    async def close(self):
+        await self.redis_client.aclose()
+
+
+class LoginRateLimiter:
+    """Limits login attempts per username and per client IP before any password is hashed
+
+    A username or IP that already had attempts in the window without logging in
+    is flagged in this process. Its password checks get the hasher's leftover
+    capacity only, and at most max_concurrent_per_ip of them run at once per IP,
+    so the attempts the limits still allow can't crowd out other users.
+    """
+
+    max_flags = 100000
+
+    def __init__(self, backend_factory: Callable, window: float, per_user: int, per_ip: int,
+                 max_concurrent_per_ip: int = 1):
+        self.backend_factory = backend_factory
+        self._backend = None
+        self.window = window
+        self.per_user = per_user
+        self.per_ip = per_ip
+        self.max_concurrent_per_ip = max_concurrent_per_ip
+        # rate limit key -> monotonic time its flag expires
+        self._flagged: Dict[str, float] = {}
+        # password checks in flight per IP
+        self._verifying: Counter = Counter()
+
+    @property
+    def backend(self):
+        # built on first use (or by start()) rather than at import
+        if self._backend is None:
+            self._backend = self.backend_factory()
+        return self._backend
+
+    def start(self):
+        self.backend
+
+    @staticmethod
+    def _keys(username: str, ip: Optional[str]) -> List[str]:
+        return [f"login:user:{username}", f"login:ip:{ip}"] if ip else [f"login:user:{username}"]
+
+    def _flag(self, keys: List[str]):
+        now = time.monotonic()
+        if len(self._flagged) > self.max_flags:
+            self._flagged = {key: until for key, until in self._flagged.items() if until > now}
+        for key in keys:
+            self._flagged[key] = now + self.window
+
+    def flagged(self, username: str, ip: Optional[str]) -> bool:
+        """True if the username or the IP had attempts in the window that didn't log in"""
+        now = time.monotonic()
+        return any(self._flagged.get(key, 0) > now for key in self._keys(username, ip))
+
+    async def check(self, username: str, ip: Optional[str]):
+        """Count this attempt, raise 429 if the username or the IP is over its limit"""
+        keys = self._keys(username, ip)
+        limits = [self.per_user, self.per_ip][:len(keys)]
+        try:
+            retry_after, prior = await self.backend.hit(keys, limits, self.window)
+        except Exception as e:
+            # an unreachable limiter shouldn't lock everyone out, bcrypt stays bounded by the hasher
+            print(f"Login rate limiter unavailable: {e}")
+            return
+        if prior:
+            self._flag(keys)
+        if retry_after > 0:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts, please retry later",
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+            )
+
+    @asynccontextmanager
+    async def verifying(self, username: str, ip: Optional[str]):
+        """Wrap a login's password check, yields the flagged check to pass to the hasher"""
+        def flagged() -> bool:
+            return self.flagged(username, ip)
+
+        if ip and flagged() and self._verifying[ip] >= self.max_concurrent_per_ip:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts, please retry later",
+                headers={"Retry-After": "1"},
+            )
+        if ip:
+            self._verifying[ip] += 1
+        try:
+            yield flagged
+        finally:
+            if ip:
+                self._verifying[ip] -= 1
+                if not self._verifying[ip]:
+                    del self._verifying[ip]
+
+    async def reset(self, username: str):
+        """Clear the username's window after a successful login"""
+        self._flagged.pop(f"login:user:{username}", None)
+        try:
+            await self.backend.reset(f"login:user:{username}")
+        except Exception as e:
+            print(f"Login rate limiter unavailable: {e}")
+
+    async def close(self):
+        if self._backend is not None:
+            await self._backend.close()
+            self._backend = None
+
+
+def create_backend():
+    # memory keeps the windows per worker process, redis shares them between workers
+    settings = get_settings()
+    if settings.login_rate_limit_backend == "redis":
+        return RedisRateLimiter(settings.redis_host, settings.redis_port, settings.redis_db, settings.redis_max_connections)
+    return MemoryRateLimiter()
+
+
+login_rate_limiter = LoginRateLimiter(
+    create_backend,
+    get_settings().login_rate_window,
+    get_settings().login_max_attempts_per_user,
+    get_settings().login_max_attempts_per_ip,
+    get_settings().login_max_concurrent_per_ip,
+)
@@ -0,0 +1,127 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from dotenv import load_dotenv
+
+
+def _flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() == "true"
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Every setting of the Auth service, read from the environment (and .env) once"""
+
+    # Supabase, the pooled connection is shared by every request of this worker
+    supabase_url: Optional[str]
+    supabase_key: Optional[str]
+    supabase_max_connections: int
+    supabase_max_keepalive: int
+    supabase_keepalive_expiry: float
+    supabase_timeout: float
+
+    # JWT
+    jwt_algorithm: str
+    jwt_secret_key: Optional[str]
+    jwt_private_key_file: Optional[str]
+    jwt_public_key_file: Optional[str]
+    access_token_expire_minutes: int
+    # Put the public profile in the token so authenticated requests skip the user lookup.
+    # Changes (disabled, verified, email) then only show up in tokens issued afterwards.
+    jwt_embed_user_claims: bool
+    token_cache_size: int
+
+    # bcrypt process pool
+    password_hash_workers: int
+    password_hash_max_pending: int
+    # slots only logins from clients that aren't failing may use
+    password_hash_reserved: int
+
+    # user cache, other workers' writes show up within the TTL
+    user_cache_size: int
+    user_cache_ttl: float
+
+    # password reset tokens
+    password_reset_ttl_minutes: int
+    password_reset_sweep_interval: float
+    password_reset_sweep_batch: int
+
+    # email outbox, each worker keeps one SMTP connection open
+    smtp_server: str
+    smtp_port: int
+    smtp_username: Optional[str]
+    smtp_password: Optional[str]
+    smtp_starttls: bool
+    from_email: Optional[str]
+    email_workers: int
+    email_max_queue: int
+    email_max_attempts: int
+    email_retry_backoff: float
+    smtp_idle_timeout: float
+
+    # login rate limiting, memory keeps the windows per worker, redis shares them
+    login_rate_limit_backend: str
+    login_rate_window: float
+    login_max_attempts_per_user: int
+    login_max_attempts_per_ip: int
+    # concurrent password checks from an IP that is already failing
+    login_max_concurrent_per_ip: int
+    redis_host: str
+    redis_port: int
+    redis_db: int
+    redis_max_connections: int
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        load_dotenv()
+        password_hash_workers = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+        password_hash_max_pending = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(password_hash_workers * 8)))
+        return cls(
+            supabase_url=os.getenv("SUPABASE_URL"),
+            supabase_key=os.getenv("SUPABASE_KEY"),
+            supabase_max_connections=int(os.getenv("SUPABASE_MAX_CONNECTIONS", "100")),
+            supabase_max_keepalive=int(os.getenv("SUPABASE_MAX_KEEPALIVE", "20")),
+            supabase_keepalive_expiry=float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30")),
+            supabase_timeout=float(os.getenv("SUPABASE_TIMEOUT", "10")),
+            jwt_algorithm=os.getenv("JWT_ALGORITHM", "HS256"),
+            jwt_secret_key=os.getenv("JWT_SECRET_KEY"),
+            jwt_private_key_file=os.getenv("JWT_PRIVATE_KEY_FILE"),
+            jwt_public_key_file=os.getenv("JWT_PUBLIC_KEY_FILE"),
+            access_token_expire_minutes=int(os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", "30")),
+            jwt_embed_user_claims=_flag("JWT_EMBED_USER_CLAIMS", "false"),
+            token_cache_size=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+            password_hash_workers=password_hash_workers,
+            password_hash_max_pending=password_hash_max_pending,
+            password_hash_reserved=int(os.getenv("PASSWORD_HASH_RESERVED", str(password_hash_max_pending // 2))),
+            user_cache_size=int(os.getenv("USER_CACHE_SIZE", "10000")),
+            user_cache_ttl=float(os.getenv("USER_CACHE_TTL", "30")),
+            password_reset_ttl_minutes=int(os.getenv("PASSWORD_RESET_TTL_MINUTES", "60")),
+            password_reset_sweep_interval=float(os.getenv("PASSWORD_RESET_SWEEP_INTERVAL", "300")),
+            password_reset_sweep_batch=int(os.getenv("PASSWORD_RESET_SWEEP_BATCH", "1000")),
+            smtp_server=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+            smtp_port=int(os.getenv("SMTP_PORT", "587")),
+            smtp_username=os.getenv("SMTP_USERNAME"),
+            smtp_password=os.getenv("SMTP_PASSWORD"),
+            smtp_starttls=_flag("SMTP_STARTTLS", "true"),
+            from_email=os.getenv("FROM_EMAIL"),
+            email_workers=int(os.getenv("EMAIL_WORKERS", "2")),
+            email_max_queue=int(os.getenv("EMAIL_MAX_QUEUE", "10000")),
+            email_max_attempts=int(os.getenv("EMAIL_MAX_ATTEMPTS", "5")),
+            email_retry_backoff=float(os.getenv("EMAIL_RETRY_BACKOFF", "1")),
+            smtp_idle_timeout=float(os.getenv("SMTP_IDLE_TIMEOUT", "60")),
+            login_rate_limit_backend=os.getenv("LOGIN_RATE_LIMIT_BACKEND", "memory"),
+            login_rate_window=float(os.getenv("LOGIN_RATE_WINDOW", "60")),
+            login_max_attempts_per_user=int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_USER", "5")),
+            login_max_attempts_per_ip=int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_IP", "20")),
+            login_max_concurrent_per_ip=int(os.getenv("LOGIN_MAX_CONCURRENT_PER_IP", "1")),
+            redis_host=os.getenv("REDIS_HOST", "localhost"),
+            redis_port=int(os.getenv("REDIS_PORT", "6379")),
+            redis_db=int(os.getenv("REDIS_DB", "0")),
+            redis_max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    return Settings.from_env()
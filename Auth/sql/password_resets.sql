@@ -0,0 +1,99 @@
+-- Password reset tokens and the functions the Auth service calls through
+-- PostgREST (POST /rest/v1/rpc/<name>). Run once in the Supabase SQL editor.
+
+-- gen_random_bytes for the reset tokens
+create extension if not exists pgcrypto;
+
+create table if not exists password_resets (
+    id uuid primary key default gen_random_uuid(),
+    user_id uuid not null references users (id) on delete cascade,
+    reset_token text not null unique,
+    expires_at timestamptz not null,
+    created_at timestamptz not null default now()
+);
+
+-- the sweeper deletes by expiry, and consuming a token deletes by user
+create index if not exists password_resets_expires_at_idx on password_resets (expires_at);
+create index if not exists password_resets_user_id_idx on password_resets (user_id);
+
+-- no policies, so only the service role (which bypasses RLS) can read or write tokens
+alter table password_resets enable row level security;
+
+-- Looks the user up by email and stores a new random token in one statement.
+-- The token and its expiry are made here, never taken from the caller.
+-- Returns the token, or null when no user has that email.
+-- the earlier version took the token and expiry from the caller, drop it so it
+-- doesn't stay callable as an overload
+drop function if exists create_password_reset(text, text, timestamptz);
+create or replace function create_password_reset(p_email text, p_ttl_minutes integer)
+returns text
+language plpgsql
+as $$
+declare
+    v_reset_token text := encode(gen_random_bytes(32), 'hex');
+begin
+    insert into password_resets (user_id, reset_token, expires_at)
+    select id, v_reset_token, now() + make_interval(mins => least(greatest(p_ttl_minutes, 1), 1440))
+    from users where email = p_email;
+    if not found then
+        return null;
+    end if;
+    return v_reset_token;
+end;
+$$;
+
+-- Sets the new password if the token is still valid and removes every reset
+-- token of that user, atomically. Returns the username, or null for a bad token.
+create or replace function consume_password_reset(p_reset_token text, p_hashed_password text)
+returns text
+language plpgsql
+as $$
+declare
+    v_user_id uuid;
+    v_username text;
+begin
+    select user_id into v_user_id
+    from password_resets
+    where reset_token = p_reset_token and expires_at > now()
+    for update;
+
+    if v_user_id is null then
+        return null;
+    end if;
+
+    update users set hashed_password = p_hashed_password
+    where id = v_user_id
+    returning username into v_username;
+
+    delete from password_resets where user_id = v_user_id;
+    return v_username;
+end;
+$$;
+
+-- Deletes up to p_batch_size expired tokens, returns how many were deleted.
+create or replace function delete_expired_password_resets(p_batch_size integer)
+returns integer
+language plpgsql
+as $$
+declare
+    v_deleted integer;
+begin
+    delete from password_resets
+    where id in (
+        select id from password_resets
+        where expires_at <= now()
+        limit p_batch_size
+    );
+    get diagnostics v_deleted = row_count;
+    return v_deleted;
+end;
+$$;
+
+-- Functions are executable by public by default, and PostgREST exposes them
+-- under /rpc to anyone with the anon key. Only the service's key may call these.
+revoke execute on function create_password_reset(text, integer) from public, anon, authenticated;
+revoke execute on function consume_password_reset(text, text) from public, anon, authenticated;
+revoke execute on function delete_expired_password_resets(integer) from public, anon, authenticated;
+grant execute on function create_password_reset(text, integer) to service_role;
+grant execute on function consume_password_reset(text, text) to service_role;
+grant execute on function delete_expired_password_resets(integer) to service_role;
@@ -0,0 +1,62 @@
+"""Boot time report for the Auth service: python main.py --profile-startup
+
+Import times come from a fresh interpreter run with -X importtime, so they
+match what a newly scaled-up worker pays. The lifespan startup is timed
+in this process on top of that.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """(module, self us, cumulative us) for every import triggered by importing module"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in result.stderr.splitlines():
+        # import time:       self [us] |   cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+async def _time_lifespan(app) -> float:
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def report(module: str = "main", top: int = 25):
+    rows = import_times(module)
+    local = {name[:-3] for name in os.listdir(os.path.dirname(os.path.abspath(__file__))) if name.endswith(".py")}
+    total = next((cumulative for name, _, cumulative in rows if name == module), 0)
+
+    print(f"Importing {module}: {total / 1000:.1f} ms ({len(rows)} modules)\n")
+    print(f"{'cumulative':>12}{'self':>10}  module")
+    for name, self_us, cumulative_us in sorted(rows, key=lambda row: row[2], reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>9.1f} ms{self_us / 1000:>7.1f} ms  {name}")
+
+    print(f"\n{'cumulative':>12}{'self':>10}  this service's modules")
+    for name, self_us, cumulative_us in rows:
+        if name in local:
+            print(f"{cumulative_us / 1000:>9.1f} ms{self_us / 1000:>7.1f} ms  {name}")
+
+    app = getattr(__import__(module), "app")
+    print(f"\nLifespan startup: {asyncio.run(_time_lifespan(app)) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    report()
@@ -0,0 +1,140 @@
+import hashlib
+import sys
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from functools import lru_cache
+from typing import Dict, Optional
+from jose import JWTError, jwk, jwt
+from settings import get_settings
+
+ASYMMETRIC_PREFIXES = ("RS", "PS", "ES")
+
+
+def _read_key(path: Optional[str]) -> Optional[str]:
+    if not path:
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+class TokenService:
+    """Signs and verifies JWTs with key material parsed once, caching verified claims until they expire"""
+
+    def __init__(self, algorithm: str, secret_key: Optional[str] = None, private_key: Optional[str] = None,
+                 public_key: Optional[str] = None, cache_size: int = 10000):
+        self.algorithm = algorithm
+        self.asymmetric = algorithm.startswith(ASYMMETRIC_PREFIXES)
+        self.cache_size = cache_size
+        # jose accepts constructed keys, so PEM parsing happens here instead of on every call
+        if self.asymmetric:
+            self._signing_key = jwk.construct(private_key, algorithm) if private_key else None
+            if public_key:
+                self._verifying_key = jwk.construct(public_key, algorithm)
+            elif self._signing_key is not None:
+                self._verifying_key = self._signing_key.public_key()
+            else:
+                self._verifying_key = None
+        else:
+            self._signing_key = jwk.construct(secret_key, algorithm) if secret_key else None
+            self._verifying_key = self._signing_key
+        self._claims: "OrderedDict[bytes, tuple]" = OrderedDict()
+
+    def encode(self, claims: Dict, expires_delta: timedelta) -> str:
+        if self._signing_key is None:
+            raise JWTError(f"No signing key configured for {self.algorithm}")
+        to_encode = dict(claims)
+        to_encode["exp"] = int(time.time() + expires_delta.total_seconds())
+        return jwt.encode(to_encode, self._signing_key, algorithm=self.algorithm)
+
+    def decode(self, token: str) -> Dict:
+        """Claims of a valid token, raises JWTError otherwise"""
+        key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        entry = self._claims.get(key)
+        if entry is not None:
+            expires_at, claims = entry
+            if expires_at > time.time():
+                self._claims.move_to_end(key)
+                return dict(claims)
+            del self._claims[key]
+
+        if self._verifying_key is None:
+            raise JWTError(f"No verification key configured for {self.algorithm}")
+        claims = jwt.decode(token, self._verifying_key, algorithms=[self.algorithm])
+
+        # only tokens that expire are cached, and never past their exp
+        expires_at = claims.get("exp")
+        if self.cache_size > 0 and isinstance(expires_at, (int, float)):
+            self._claims[key] = (expires_at, claims)
+            while len(self._claims) > self.cache_size:
+                self._claims.popitem(last=False)
+        return dict(claims)
+
+    def public_jwks(self) -> Dict:
+        """JWK set with the public key, empty for shared-secret algorithms"""
+        if not self.asymmetric or self._verifying_key is None:
+            return {"keys": []}
+        key = self._verifying_key.to_dict()
+        key["use"] = "sig"
+        return {"keys": [key]}
+
+    def clear(self):
+        self._claims.clear()
+
+
+@lru_cache(maxsize=None)
+def get_token_service() -> TokenService:
+    """The service's TokenService, keys are read and parsed on the first call"""
+    # HS256 signs with JWT_SECRET_KEY. RS256/RS384/RS512 sign with the private key file
+    # and verify with the public one, so other services can check tokens on their own.
+    settings = get_settings()
+    return TokenService(
+        settings.jwt_algorithm,
+        secret_key=settings.jwt_secret_key,
+        private_key=_read_key(settings.jwt_private_key_file),
+        public_key=_read_key(settings.jwt_public_key_file),
+        cache_size=settings.token_cache_size,
+    )
+
+
+def _rate(func, seconds: float = 1.0) -> float:
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        func()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def benchmark():
+    """Encode/decode throughput with and without the verified-claims cache"""
+    import rsa
+
+    public, private = rsa.newkeys(2048)
+    services = {
+        "HS256": TokenService("HS256", secret_key="benchmark-secret-key-0123456789abcdef"),
+        "RS256": TokenService("RS256", private_key=private.save_pkcs1().decode(), public_key=public.save_pkcs1().decode()),
+    }
+    claims = {"sub": "benchmark-user"}
+    expires = timedelta(minutes=30)
+
+    print(f"{'algorithm':<10}{'encode/s':>12}{'decode/s':>12}{'cached/s':>12}{'jose/s':>12}")
+    for name, service in services.items():
+        token = service.encode(claims, expires)
+        key = service._verifying_key
+        encode = _rate(lambda: service.encode(claims, expires))
+        uncached = TokenService(name, cache_size=0)
+        uncached._verifying_key = key
+        decode = _rate(lambda: uncached.decode(token))
+        cached = _rate(lambda: service.decode(token))
+        # what every request paid before: key parsing plus signature check
+        raw_key = "benchmark-secret-key-0123456789abcdef" if name == "HS256" else public.save_pkcs1().decode()
+        plain = _rate(lambda: jwt.decode(token, raw_key, algorithms=[name]))
+        print(f"{name:<10}{encode:>12,.0f}{decode:>12,.0f}{cached:>12,.0f}{plain:>12,.0f}")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        benchmark()
+    else:
+        print("usage: python tokens.py --bench")
@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+from models import UserInDB
+from settings import get_settings
+
+class UserCache:
+    """In-process TTL + LRU cache of users keyed by username"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # bumped by every invalidate, so a fetch that raced one can be told apart
+        self._generation = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        # fetches older than this are never cached, their usernames' generations were dropped
+        self._floor = 0
+
+    def generation(self) -> int:
+        """Take before fetching a user, and pass to set() with the result"""
+        return self._generation
+
+    def get(self, username: str) -> Optional[UserInDB]:
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[username]
+            return None
+        self._entries.move_to_end(username)
+        return user
+
+    def set(self, username: str, user: UserInDB, generation: int):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        # invalidated while it was being fetched, it may predate the change (e.g. an old password hash)
+        if generation < self._floor or self._invalidated.get(username, -1) > generation:
+            return
+        self._entries[username] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        self._entries.pop(username, None)
+        self._generation += 1
+        self._invalidated[username] = self._generation
+        self._invalidated.move_to_end(username)
+        while len(self._invalidated) > self.maxsize:
+            _, self._floor = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self._invalidated.clear()
+        self._generation += 1
+        self._floor = self._generation
+
+# Entries live at most USER_CACHE_TTL seconds, other workers' writes show up within that window
+user_cache = UserCache(get_settings().user_cache_size, get_settings().user_cache_ttl)
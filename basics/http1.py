@@ -1,10 +1,10 @@
-from fastapi import FastAPI
-import json
+from fastapi import FastAPI, Query, Header
+from fastapi.responses import StreamingResponse
+from typing import Literal, Optional
+from patient_store import PatientRepository
+from http_cache import cached_json_response
 
-def load_data():
-    with open('patient.json','r') as f:
-        data = json.load(f)
-    return data    
+repository = PatientRepository('patient.json')
  
 app = FastAPI()
 
@@ -13,6 +13,12 @@ def hello():
     return {'message':'patient management system api'}
 
 @app.get("/view")
-def view():
-    data = load_data()
-    return data
\ No newline at end of file
+def view(format: Literal['json', 'ndjson', 'array'] = Query('json', description='json returns the whole dict, ndjson and array stream one patient at a time'),
+         if_none_match: Optional[str] = Header(None)):
+    if format == 'ndjson':
+        return StreamingResponse(repository.iter_ndjson(), media_type='application/x-ndjson')
+    if format == 'array':
+        return StreamingResponse(repository.iter_json_array(), media_type='application/json')
+
+    body, etag = repository.encoded_all()
+    return cached_json_response(body, etag, if_none_match)
\ No newline at end of file
@@ -0,0 +1,18 @@
+from typing import Optional
+from fastapi import Response
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison, so W/"x" matches "x"
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+def cached_json_response(body: bytes, etag: str, if_none_match: Optional[str]) -> Response:
+    """Send pre-encoded JSON as-is, or an empty 304 if the client already has this version"""
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(content=body, media_type='application/json', headers={'ETag': etag})
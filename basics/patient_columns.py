@@ -0,0 +1,174 @@
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# numeric patient fields mirrored as float64 columns
+NUMERIC_FIELDS = ['age', 'height', 'weight', 'bmi']
+
+# fields summarised per city by /stats/cities
+CITY_STAT_FIELDS = ['age', 'height', 'weight']
+
+# results kept per distinct request (bins, percentiles), least recently used dropped first
+MAX_CACHED_RESULTS = 32
+
+
+def bmi_histogram(bmi: np.ndarray, bins: int) -> dict:
+    counts, edges = np.histogram(bmi, bins=bins)
+    return {'edges': np.round(edges, 2).tolist(), 'counts': counts.tolist()}
+
+
+def city_summary(cities: np.ndarray, city_names: List[str], values: Dict[str, np.ndarray], percentiles: Sequence[float]) -> Dict[str, dict]:
+    """Count, mean and percentiles of each column in ``values`` per city code"""
+    counts = np.bincount(cities, minlength=len(city_names))
+    present = np.flatnonzero(counts)
+    bounds = np.concatenate(([0], np.cumsum(counts[present])))
+    stats = {city_names[code]: {'count': int(counts[code])} for code in present}
+
+    # rows of each city become contiguous once ordered by city code
+    by_city = np.argsort(cities, kind='stable')
+    for field, column in values.items():
+        sums = np.bincount(cities, weights=column, minlength=len(counts))
+        ordered = column[by_city]
+        for i, code in enumerate(present):
+            group = ordered[bounds[i]:bounds[i + 1]]
+            summary = {'mean': round(float(sums[code] / counts[code]), 2)}
+            for p, value in zip(percentiles, np.percentile(group, percentiles)):
+                summary[f'p{p:g}'] = round(float(value), 2)
+            stats[city_names[code]][field] = summary
+
+    return stats
+
+
+class _Labels:
+    """Interns repeated strings (city, verdict) as small integer codes"""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.names: List[str] = []
+
+    def code(self, name: str) -> int:
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+
+def _row(record: dict) -> Optional[Tuple[List[float], str, str]]:
+    """Numeric fields, city and verdict of a record, None if any of them is missing"""
+    city, verdict = record.get('city'), record.get('verdict')
+    values = [record.get(field) for field in NUMERIC_FIELDS]
+    if city is None or verdict is None or None in values:
+        return None
+    try:
+        return [float(value) for value in values], city, verdict
+    except (TypeError, ValueError):
+        return None
+
+
+class PatientColumns:
+    """Columnar NumPy mirror of the patient store for batch analytics
+
+    Each patient owns one row across the arrays. Deleted rows are flagged
+    invalid and reused by the next insert, so writes are O(1) and every
+    aggregate is a vectorized pass over the valid rows. Results are cached
+    until the next write. Patients missing one of the fields get no row and
+    are left out of the aggregates.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        self._rows: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._size = 0
+        self._numeric = {field: np.zeros(capacity) for field in NUMERIC_FIELDS}
+        self._city = np.zeros(capacity, dtype=np.int32)
+        self._verdict = np.zeros(capacity, dtype=np.int32)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._cities = _Labels()
+        self._verdicts = _Labels()
+        self._cache: "OrderedDict[tuple, object]" = OrderedDict()
+
+    def _grow(self):
+        capacity = len(self._valid) * 2
+        for field, column in self._numeric.items():
+            self._numeric[field] = np.resize(column, capacity)
+        self._city = np.resize(self._city, capacity)
+        self._verdict = np.resize(self._verdict, capacity)
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:self._size] = self._valid[:self._size]
+        self._valid = valid
+
+    def rebuild(self, patients: Dict[str, dict]):
+        rows = []
+        for patient_id, record in patients.items():
+            fields = _row(record)
+            if fields is not None:
+                rows.append((patient_id, fields))
+        n = len(rows)
+        self._allocate(max(1024, n))
+        for i, field in enumerate(NUMERIC_FIELDS):
+            self._numeric[field][:n] = [values[i] for _, (values, _, _) in rows]
+        self._city[:n] = [self._cities.code(city) for _, (_, city, _) in rows]
+        self._verdict[:n] = [self._verdicts.code(verdict) for _, (_, _, verdict) in rows]
+        self._valid[:n] = True
+        self._rows = {patient_id: row for row, (patient_id, _) in enumerate(rows)}
+        self._size = n
+
+    def add(self, patient_id: str, record: dict):
+        fields = _row(record)
+        if fields is None:
+            return
+        values, city, verdict = fields
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self._size == len(self._valid):
+                self._grow()
+            row = self._size
+            self._size += 1
+
+        for field, value in zip(NUMERIC_FIELDS, values):
+            self._numeric[field][row] = value
+        self._city[row] = self._cities.code(city)
+        self._verdict[row] = self._verdicts.code(verdict)
+        self._valid[row] = True
+        self._rows[patient_id] = row
+        self._cache.clear()
+
+    def remove(self, patient_id: str, record: dict):
+        row = self._rows.pop(patient_id, None)
+        if row is not None:
+            self._valid[row] = False
+            self._free.append(row)
+            self._cache.clear()
+
+    def _column(self, values: np.ndarray) -> np.ndarray:
+        return values[:self._size][self._valid[:self._size]]
+
+    def _cached(self, key: tuple, compute: Callable[[], object]):
+        # keys come from request parameters, so the cache is bounded
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        result = self._cache[key] = compute()
+        if len(self._cache) > MAX_CACHED_RESULTS:
+            self._cache.popitem(last=False)
+        return result
+
+    def verdict_counts(self) -> Dict[str, int]:
+        def compute():
+            counts = np.bincount(self._column(self._verdict), minlength=len(self._verdicts.names))
+            return {name: int(count) for name, count in zip(self._verdicts.names, counts) if count}
+        return self._cached(('verdicts',), compute)
+
+    def bmi_histogram(self, bins: int) -> dict:
+        return self._cached(('bmi', bins), lambda: bmi_histogram(self._column(self._numeric['bmi']), bins))
+
+    def city_stats(self, percentiles: Sequence[float]) -> Dict[str, dict]:
+        def compute():
+            values = {field: self._column(self._numeric[field]) for field in CITY_STAT_FIELDS}
+            return city_summary(self._column(self._city), self._cities.names, values, percentiles)
+        return self._cached(('cities', tuple(percentiles)), compute)
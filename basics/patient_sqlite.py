@@ -0,0 +1,269 @@
+import argparse
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from patient_columns import CITY_STAT_FIELDS, bmi_histogram, city_summary
+from patient_store import HASH_FIELDS, SORT_FIELDS, STREAM_BATCH_SIZE, PatientRepository, PatientStore, encode_json, etag
+
+COLUMNS = ['id', 'name', 'city', 'age', 'gender', 'height', 'weight', 'bmi', 'verdict']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS patients (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    city TEXT NOT NULL,
+    age INTEGER NOT NULL,
+    gender TEXT NOT NULL,
+    height REAL NOT NULL,
+    weight REAL NOT NULL,
+    bmi REAL NOT NULL,
+    verdict TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS patients_city ON patients (city);
+CREATE INDEX IF NOT EXISTS patients_gender ON patients (gender);
+CREATE INDEX IF NOT EXISTS patients_verdict ON patients (verdict);
+CREATE INDEX IF NOT EXISTS patients_age ON patients (age);
+CREATE INDEX IF NOT EXISTS patients_height ON patients (height, id);
+CREATE INDEX IF NOT EXISTS patients_weight ON patients (weight, id);
+CREATE INDEX IF NOT EXISTS patients_bmi ON patients (bmi, id);
+'''
+
+SELECT_PATIENT = f'SELECT {", ".join(COLUMNS)} FROM patients'
+INSERT_PATIENT = f'INSERT INTO patients ({", ".join(COLUMNS)}) VALUES ({", ".join("?" * len(COLUMNS))}) ON CONFLICT (id) DO NOTHING'
+UPDATE_PATIENT = f'UPDATE patients SET {", ".join(f"{column} = ?" for column in COLUMNS[1:])} WHERE id = ?'
+
+
+def _record(row: sqlite3.Row) -> dict:
+    record = dict(row)
+    del record['id']
+    return record
+
+
+def _patient(row: sqlite3.Row) -> dict:
+    return dict(row)
+
+
+def _values(patient_id: str, record: dict) -> tuple:
+    return (patient_id, *(record[column] for column in COLUMNS[1:]))
+
+
+class SQLitePatientRepository(PatientStore):
+    """Patient store on an SQLite database in WAL mode
+
+    Every threadpool thread gets its own connection, so readers run in
+    parallel and never wait on the single writer. Sorting, filtering and
+    counting are done by SQLite on indexed columns. The /view body is cached
+    until a write, from this process or any other.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        # bumped by every commit here and every change another connection made,
+        # the cached /view body is only served while it hasn't moved
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        self._encoded_all: Optional[Tuple[int, bytes, str]] = None
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        # take the write lock up front so check-then-write can't race another writer
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        with self._generation_lock:
+            self._generation += 1
+
+    def _current_generation(self) -> int:
+        # data_version moves when another connection commits, another thread's or another process'.
+        # a connection's first look can't tell what it missed, so it counts as a change too
+        data_version = self._connection().execute('PRAGMA data_version').fetchone()[0]
+        with self._generation_lock:
+            if getattr(self._local, 'data_version', None) != data_version:
+                self._local.data_version = data_version
+                self._generation += 1
+            return self._generation
+
+    def all(self) -> Dict[str, dict]:
+        return {row['id']: _record(row) for row in self._connection().execute(SELECT_PATIENT)}
+
+    def get(self, patient_id: str) -> Optional[dict]:
+        row = self._connection().execute(f'{SELECT_PATIENT} WHERE id = ?', (patient_id,)).fetchone()
+        return None if row is None else _record(row)
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+
+    def sort(self, field: str, descending: bool = False, offset: int = 0, limit: Optional[int] = None) -> List[dict]:
+        if field not in SORT_FIELDS:
+            raise ValueError(f'Cannot sort on {field}')
+        # ties broken by id, in the same direction as the in-memory SortedIndex
+        direction = 'DESC' if descending else 'ASC'
+        rows = self._connection().execute(
+            f'{SELECT_PATIENT} ORDER BY {field} {direction}, id {direction} LIMIT ? OFFSET ?',
+            (-1 if limit is None else limit, offset),
+        )
+        return [_record(row) for row in rows]
+
+    def search(self, filters: Dict[str, object], min_age: Optional[int] = None, max_age: Optional[int] = None,
+               offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[dict]]:
+        conditions = []
+        params = []
+        for field, value in filters.items():
+            if field not in HASH_FIELDS:
+                raise ValueError(f'Cannot filter on {field}')
+            conditions.append(f'{field} = ?')
+            params.append(value)
+        if min_age is not None:
+            conditions.append('age >= ?')
+            params.append(min_age)
+        if max_age is not None:
+            conditions.append('age <= ?')
+            params.append(max_age)
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+        db = self._connection()
+        count = db.execute(f'SELECT COUNT(*) FROM patients{where}', params).fetchone()[0]
+        rows = db.execute(f'{SELECT_PATIENT}{where} ORDER BY id LIMIT ? OFFSET ?', (*params, -1 if limit is None else limit, offset))
+        return count, [_patient(row) for row in rows]
+
+    def verdict_counts(self) -> Dict[str, int]:
+        rows = self._connection().execute('SELECT verdict, COUNT(*) FROM patients GROUP BY verdict')
+        return {verdict: count for verdict, count in rows}
+
+    def _column(self, sql: str, dtype=float) -> np.ndarray:
+        return np.fromiter((row[0] for row in self._connection().execute(sql)), dtype=dtype)
+
+    def bmi_histogram(self, bins: int) -> dict:
+        return bmi_histogram(self._column('SELECT bmi FROM patients'), bins)
+
+    def city_stats(self, percentiles: Sequence[float]) -> Dict[str, dict]:
+        rows = self._connection().execute(f'SELECT city, {", ".join(CITY_STAT_FIELDS)} FROM patients').fetchall()
+        city_names, cities = np.unique(np.array([row[0] for row in rows], dtype=object), return_inverse=True)
+        values = {field: np.fromiter((row[i] for row in rows), dtype=float, count=len(rows))
+                  for i, field in enumerate(CITY_STAT_FIELDS, start=1)}
+        return city_summary(cities, list(city_names), values, percentiles)
+
+    def encoded_all(self) -> Tuple[bytes, str]:
+        # the generation is read before the table, a write in between makes the entry stale at once
+        generation = self._current_generation()
+        cached = self._encoded_all
+        if cached is not None and cached[0] == generation:
+            return cached[1], cached[2]
+        body = encode_json(self.all())
+        self._encoded_all = (generation, body, etag(body))
+        return body, self._encoded_all[2]
+
+    def iter_patients(self, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[List[dict]]:
+        # keyset pagination: each batch is its own query, so it can run on whichever
+        # threadpool thread the StreamingResponse happens to pull it from
+        last_id = ''
+        while True:
+            rows = self._connection().execute(f'{SELECT_PATIENT} WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            yield [_patient(row) for row in rows]
+            last_id = rows[-1]['id']
+
+    def create(self, patient_id: str, record: dict) -> bool:
+        with self._transaction() as db:
+            return db.execute(INSERT_PATIENT, _values(patient_id, record)).rowcount == 1
+
+    def update(self, patient_id: str, change: Callable[[dict], dict]) -> Optional[dict]:
+        with self._transaction() as db:
+            row = db.execute(f'{SELECT_PATIENT} WHERE id = ?', (patient_id,)).fetchone()
+            if row is None:
+                return None
+            record = change(_record(row))
+            db.execute(UPDATE_PATIENT, (*_values(patient_id, record)[1:], patient_id))
+            return record
+
+    def delete(self, patient_id: str) -> bool:
+        with self._transaction() as db:
+            return db.execute('DELETE FROM patients WHERE id = ?', (patient_id,)).rowcount == 1
+
+    def create_many(self, records: Dict[str, dict]) -> Dict[str, str]:
+        errors = {}
+        with self._transaction() as db:
+            for patient_id, record in records.items():
+                if db.execute(INSERT_PATIENT, _values(patient_id, record)).rowcount == 0:
+                    errors[patient_id] = 'Patient already exists'
+        return errors
+
+    def update_many(self, changes: List[Tuple[str, Callable[[dict], dict]]]) -> Dict[str, Union[str, ValueError]]:
+        errors = {}
+        updated = {}
+        with self._transaction() as db:
+            for patient_id, change in changes:
+                if patient_id in errors:
+                    continue
+                # a patient's changes are written only if all of them apply
+                existing = updated.get(patient_id)
+                if existing is None:
+                    row = db.execute(f'{SELECT_PATIENT} WHERE id = ?', (patient_id,)).fetchone()
+                    if row is None:
+                        errors[patient_id] = 'Patient not found'
+                        continue
+                    existing = _record(row)
+                try:
+                    updated[patient_id] = change(existing)
+                except ValueError as e:
+                    errors[patient_id] = e
+                    updated.pop(patient_id, None)
+            db.executemany(UPDATE_PATIENT, [(*_values(patient_id, record)[1:], patient_id)
+                                            for patient_id, record in updated.items()])
+        return errors
+
+    def delete_many(self, patient_ids: List[str]) -> Dict[str, str]:
+        errors = {}
+        with self._transaction() as db:
+            for patient_id in dict.fromkeys(patient_ids):
+                if db.execute('DELETE FROM patients WHERE id = ?', (patient_id,)).rowcount == 0:
+                    errors[patient_id] = 'Patient not found'
+        return errors
+
+
+def migrate(json_path: str, db_path: str) -> int:
+    """Import a patients JSON file (and its journal, if any) into an SQLite database"""
+    source = PatientRepository(json_path, journal=os.path.exists(f'{json_path}.log'))
+    target = SQLitePatientRepository(db_path)
+    records = source.all()
+    skipped = target.create_many(records)
+    for patient_id in skipped:
+        print(f'skipped {patient_id}: already in {db_path}')
+    return len(records) - len(skipped)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Patient SQLite storage tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help='import an existing patient JSON file')
+    migrate_parser.add_argument('json_path', nargs='?', default='patient.json')
+    migrate_parser.add_argument('db_path', nargs='?', default='patients.db')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        imported = migrate(args.json_path, args.db_path)
+        print(f'imported {imported} patients from {args.json_path} into {args.db_path}')
@@ -0,0 +1,657 @@
+import bisect
+import hashlib
+import heapq
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from patient_columns import PatientColumns
+
+# fields the /sort endpoint can order by, each backed by a SortedIndex
+SORT_FIELDS = ['height', 'weight', 'bmi']
+
+# equality filters of /patients/search, each backed by a HashIndex
+HASH_FIELDS = ['city', 'gender', 'verdict']
+
+# patients encoded per chunk when streaming, keeps read lock hold times short
+STREAM_BATCH_SIZE = 500
+
+# commits at least this large rebuild the indexes instead of bisecting entry by entry
+BULK_REINDEX_SIZE = 1000
+
+
+# same compact encoding FastAPI's JSONResponse produces
+def encode_json(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def etag(body: bytes) -> str:
+    """Strong ETag derived from the encoded body, stable across restarts"""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+class SortedIndex:
+    """Patient IDs kept ordered by one field, maintained with bisect on every write"""
+
+    def __init__(self, field: str):
+        self.field = field
+        self._keys: List[tuple] = []
+
+    def _key(self, patient_id: str, record: dict) -> tuple:
+        # same default as the old sorted(..., key=lambda x: x.get(sort_by, 0))
+        return (record.get(self.field, 0), patient_id)
+
+    def rebuild(self, patients: Dict[str, dict]):
+        self._keys = sorted(self._key(pid, record) for pid, record in patients.items())
+
+    def add(self, patient_id: str, record: dict):
+        bisect.insort(self._keys, self._key(patient_id, record))
+
+    def remove(self, patient_id: str, record: dict):
+        key = self._key(patient_id, record)
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def count_range(self, low=None, high=None) -> int:
+        start, stop = self._range(low, high)
+        return stop - start
+
+    def range_ids(self, low=None, high=None) -> List[str]:
+        """Patient IDs whose value lies in [low, high], either bound optional"""
+        start, stop = self._range(low, high)
+        return [pid for _, pid in self._keys[start:stop]]
+
+    def _range(self, low, high):
+        start = 0 if low is None else bisect.bisect_left(self._keys, low, key=lambda k: k[0])
+        stop = len(self._keys) if high is None else bisect.bisect_right(self._keys, high, key=lambda k: k[0])
+        return start, max(start, stop)
+
+    def ids(self, descending: bool = False, offset: int = 0, limit: Optional[int] = None) -> List[str]:
+        """Slice of patient IDs in index order without touching the rest of the index"""
+        n = len(self._keys)
+        if descending:
+            stop = max(n - offset, 0)
+            start = 0 if limit is None else max(stop - limit, 0)
+            return [pid for _, pid in reversed(self._keys[start:stop])]
+
+        stop = n if limit is None else offset + limit
+        return [pid for _, pid in self._keys[offset:stop]]
+
+
+class HashIndex:
+    """Patient IDs grouped by the exact value of one field"""
+
+    def __init__(self, field: str):
+        self.field = field
+        self._ids: Dict[object, set] = {}
+
+    def rebuild(self, patients: Dict[str, dict]):
+        self._ids = {}
+        for pid, record in patients.items():
+            self.add(pid, record)
+
+    def add(self, patient_id: str, record: dict):
+        self._ids.setdefault(record.get(self.field), set()).add(patient_id)
+
+    def remove(self, patient_id: str, record: dict):
+        value = record.get(self.field)
+        ids = self._ids.get(value)
+        if ids is not None:
+            ids.discard(patient_id)
+            if not ids:
+                del self._ids[value]
+
+    def get(self, value) -> set:
+        return self._ids.get(value, set())
+
+
+class ReadWriteLock:
+    """Many concurrent readers or one writer; waiting writers hold off new readers"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class PatientStore(ABC):
+    """Storage contract the patient routes are written against
+
+    PatientRepository keeps everything in memory on top of a JSON file,
+    SQLitePatientRepository (patient_sqlite.py) keeps it in an SQLite database.
+    Records are plain dicts without the ID; methods that return several
+    patients include it as ``id``.
+    """
+
+    @abstractmethod
+    def all(self) -> Dict[str, dict]:
+        ...
+
+    @abstractmethod
+    def get(self, patient_id: str) -> Optional[dict]:
+        ...
+
+    def __contains__(self, patient_id: str) -> bool:
+        return self.get(patient_id) is not None
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def sort(self, field: str, descending: bool = False, offset: int = 0, limit: Optional[int] = None) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def search(self, filters: Dict[str, object], min_age: Optional[int] = None, max_age: Optional[int] = None,
+               offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[dict]]:
+        ...
+
+    @abstractmethod
+    def verdict_counts(self) -> Dict[str, int]:
+        ...
+
+    @abstractmethod
+    def bmi_histogram(self, bins: int) -> dict:
+        ...
+
+    @abstractmethod
+    def city_stats(self, percentiles: Sequence[float]) -> Dict[str, dict]:
+        ...
+
+    @abstractmethod
+    def iter_patients(self, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[List[dict]]:
+        ...
+
+    def encoded(self, patient_id: str) -> Optional[Tuple[bytes, str]]:
+        """JSON bytes and ETag of one patient, None if it doesn't exist"""
+        record = self.get(patient_id)
+        if record is None:
+            return None
+        body = encode_json(record)
+        return body, etag(body)
+
+    def encoded_all(self) -> Tuple[bytes, str]:
+        """JSON bytes and ETag of the whole {patient_id: record} dict served by /view"""
+        body = encode_json(self.all())
+        return body, etag(body)
+
+    def iter_ndjson(self) -> Iterator[bytes]:
+        """One JSON object per line, for StreamingResponse"""
+        for batch in self.iter_patients():
+            yield ''.join(json.dumps(patient) + '\n' for patient in batch).encode()
+
+    def iter_json_array(self) -> Iterator[bytes]:
+        """A JSON array of patients produced chunk by chunk, for StreamingResponse"""
+        yield b'['
+        first = True
+        for batch in self.iter_patients():
+            if not batch:
+                continue
+            chunk = ','.join(json.dumps(patient) for patient in batch)
+            yield (chunk if first else ',' + chunk).encode()
+            first = False
+        yield b']'
+
+    @abstractmethod
+    def create(self, patient_id: str, record: dict) -> bool:
+        ...
+
+    @abstractmethod
+    def update(self, patient_id: str, change: Callable[[dict], dict]) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def delete(self, patient_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    def create_many(self, records: Dict[str, dict]) -> Dict[str, str]:
+        ...
+
+    @abstractmethod
+    def update_many(self, changes: List[Tuple[str, Callable[[dict], dict]]]) -> Dict[str, Union[str, ValueError]]:
+        ...
+
+    @abstractmethod
+    def delete_many(self, patient_ids: List[str]) -> Dict[str, str]:
+        ...
+
+
+class PatientRepository(PatientStore):
+    """Patient records loaded once from a JSON file and indexed by patient ID
+
+    With journal=True every mutation is appended as one JSON line to
+    ``<path>.log`` and fsync'd, instead of rewriting the whole file. Every
+    ``compact_every`` entries the log is set aside as ``<path>.log.old`` and
+    folded into the snapshot file by a background thread, so writes never
+    wait on a full rewrite.
+
+    The routes using it are sync and run on FastAPI's threadpool, so reads
+    share a ReadWriteLock and every check-then-write happens under the
+    write side of it.
+    """
+
+    def __init__(self, path: str, journal: bool = False, compact_every: int = 1000):
+        self.path = path
+        self.journal = journal
+        self.journal_path = f'{path}.log'
+        # the log being folded into the snapshot by a compaction
+        self.compacting_path = f'{self.journal_path}.old'
+        self.compact_every = compact_every
+        self._patients: Dict[str, dict] = {}
+        self._signature = None
+        self._journal_file = None
+        self._journal_entries = 0
+        self._compaction: Optional[threading.Thread] = None
+        self._sort_indexes = {field: SortedIndex(field) for field in SORT_FIELDS}
+        self._hash_indexes = {field: HashIndex(field) for field in HASH_FIELDS}
+        self._age_index = SortedIndex('age')
+        self._columns = PatientColumns()
+        # pre-encoded responses, dropped whenever the patient (or for /view, anything) changes
+        self._encoded: Dict[str, Tuple[bytes, str]] = {}
+        self._encoded_all: Optional[Tuple[bytes, str]] = None
+        self._lock = ReadWriteLock()
+        self.load()
+
+    def _file_signature(self):
+        # inode + mtime + size identify a version of the file without reading it
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """(Re)load every patient from the snapshot, replaying the journals on top"""
+        while True:
+            signature = self._file_signature()
+            if signature is None:
+                patients = {}
+            else:
+                with open(self.path, 'r') as f:
+                    patients = json.load(f)
+
+            self._patients = patients
+            self._signature = signature
+            self._encoded = {}
+            self._encoded_all = None
+            if self.journal:
+                self._replay_journal()
+            # a compaction finished while we read, the log we replayed may already be gone
+            if self._file_signature() == signature:
+                break
+        self._reindex()
+
+    def _all_indexes(self):
+        yield from self._sort_indexes.values()
+        yield from self._hash_indexes.values()
+        yield self._age_index
+        yield self._columns
+
+    def _reindex(self):
+        for index in self._all_indexes():
+            index.rebuild(self._patients)
+
+    def _replay_journal(self):
+        self._journal_entries = 0
+        # entries of an interrupted compaction first, replaying ones already in the snapshot is harmless
+        for path in (self.compacting_path, self.journal_path):
+            if os.path.exists(path):
+                self._journal_entries += self._replay(path)
+
+        if self._journal_file is None:
+            self._journal_file = open(self.journal_path, 'a')
+
+    def _replay(self, path: str) -> int:
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+
+        entries = []
+        for number, line in enumerate(lines, 1):
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('incomplete journal entry')
+                entries.append(json.loads(line))
+            except ValueError:
+                if number < len(lines):
+                    # acknowledged writes follow it, dropping them silently would lose data
+                    raise ValueError(f'{path} is corrupt at line {number}')
+                # torn last line from a crash mid-append, it was never acknowledged.
+                # drop it so new entries don't get glued onto it
+                os.truncate(path, sum(map(len, lines[:-1])))
+
+        for entry in entries:
+            self._apply(entry, index=False)
+        return len(entries)
+
+    def _index(self, patient_id: str, record: dict):
+        for index in self._all_indexes():
+            index.add(patient_id, record)
+
+    def _unindex(self, patient_id: str, record: dict):
+        for index in self._all_indexes():
+            index.remove(patient_id, record)
+
+    def _apply(self, entry: dict, index: bool = True):
+        patient_id = entry['id']
+        self._encoded.pop(patient_id, None)
+        self._encoded_all = None
+        previous = self._patients.pop(patient_id, None)
+        if index and previous is not None:
+            self._unindex(patient_id, previous)
+
+        if entry['op'] == 'put':
+            self._patients[patient_id] = entry['record']
+            if index:
+                self._index(patient_id, entry['record'])
+
+    def _apply_all(self, entries: List[dict]):
+        # each bisect insert shifts the index lists, a bulk load is cheaper to sort once
+        bulk = len(entries) >= BULK_REINDEX_SIZE
+        for entry in entries:
+            self._apply(entry, index=not bulk)
+        if bulk:
+            self._reindex()
+
+    def _commit(self, entries: List[dict]):
+        if not entries:
+            return
+
+        if not self.journal:
+            self._apply_all(entries)
+            self.save()
+            return
+
+        # log first, so memory never holds a change that is not durable
+        self._journal_file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+        self._apply_all(entries)
+
+        self._journal_entries += len(entries)
+        if self._journal_entries >= self.compact_every and self._compaction is None:
+            self._start_compaction()
+
+    def refresh(self):
+        """Reload only if the file was replaced or modified outside this process"""
+        if self._file_signature() != self._signature:
+            with self._lock.write():
+                if self._file_signature() != self._signature:
+                    self.load()
+
+    @contextmanager
+    def _reading(self):
+        self.refresh()
+        with self._lock.read():
+            yield
+
+    @contextmanager
+    def _writing(self):
+        self.refresh()
+        with self._lock.write():
+            yield
+
+    def save(self):
+        # write to a temp file and rename so readers never see a half written file
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._patients, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._signature = self._file_signature()
+
+    def _start_compaction(self):
+        # called with the write lock held. swapping the log and copying the dict
+        # are cheap, encoding and fsyncing the snapshot happen in the thread
+        if not os.path.exists(self.compacting_path):
+            self._journal_file.close()
+            os.replace(self.journal_path, self.compacting_path)
+            self._journal_file = open(self.journal_path, 'a')
+            self._journal_entries = 0
+        # else an earlier compaction didn't finish: keep both logs, the new snapshot
+        # covers them, and only the old one is removed once it is written
+        # records are replaced on write, never mutated, so a shallow copy is a consistent snapshot
+        patients = dict(self._patients)
+        self._compaction = threading.Thread(target=self._compact, args=(patients,), name='patient-compaction')
+        self._compaction.start()
+
+    def _compact(self, patients: Dict[str, dict]):
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(patients, f)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock.write():
+                os.replace(tmp_path, self.path)
+                self._signature = self._file_signature()
+            # the snapshot has every entry of the old log now. a crash before this
+            # remove just replays it again on the next load
+            os.remove(self.compacting_path)
+        finally:
+            self._compaction = None
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot and wait for it to be written"""
+        if not self.journal:
+            with self._lock.write():
+                self.save()
+            return
+        self.wait_for_compaction()
+        with self._lock.write():
+            if self._compaction is None:
+                self._start_compaction()
+        self.wait_for_compaction()
+
+    def wait_for_compaction(self):
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+
+    def all(self) -> Dict[str, dict]:
+        # records are replaced on write, never mutated, so a shallow copy is a stable view
+        with self._reading():
+            return dict(self._patients)
+
+    def get(self, patient_id: str) -> Optional[dict]:
+        with self._reading():
+            return self._patients.get(patient_id)
+
+    def __contains__(self, patient_id: str) -> bool:
+        with self._reading():
+            return patient_id in self._patients
+
+    def __len__(self) -> int:
+        with self._reading():
+            return len(self._patients)
+
+    def sort(self, field: str, descending: bool = False, offset: int = 0, limit: Optional[int] = None) -> List[dict]:
+        """Page of patients ordered by one of SORT_FIELDS"""
+        with self._reading():
+            ids = self._sort_indexes[field].ids(descending, offset, limit)
+            return [self._patients[pid] for pid in ids]
+
+    def search(self, filters: Dict[str, object], min_age: Optional[int] = None, max_age: Optional[int] = None,
+               offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[dict]]:
+        """Patients matching every equality filter (HASH_FIELDS) and the age range, ordered by ID
+
+        Returns the total number of matches and the requested page. Starts from
+        the smallest candidate set and checks the remaining conditions on the
+        record itself, so the cost follows the most selective filter.
+        """
+        with self._reading():
+            candidates = [(len(ids), ids) for ids in (self._hash_indexes[field].get(value) for field, value in filters.items())]
+            has_age = min_age is not None or max_age is not None
+            if has_age:
+                # only count the range here, the id list is built only if it is the smallest
+                candidates.append((self._age_index.count_range(min_age, max_age), None))
+
+            if candidates:
+                _, smallest = min(candidates, key=lambda c: c[0])
+                ids = self._age_index.range_ids(min_age, max_age) if smallest is None else smallest
+            else:
+                ids = self._patients
+
+            def matches(record):
+                if any(record.get(field) != value for field, value in filters.items()):
+                    return False
+                age = record.get('age')
+                return not has_age or ((min_age is None or age >= min_age) and (max_age is None or age <= max_age))
+
+            matched = [pid for pid in ids if matches(self._patients[pid])]
+            if limit is None:
+                page = sorted(matched)[offset:]
+            else:
+                page = heapq.nsmallest(offset + limit, matched)[offset:]
+            return len(matched), [{'id': pid, **self._patients[pid]} for pid in page]
+
+    def encoded(self, patient_id: str) -> Optional[Tuple[bytes, str]]:
+        with self._reading():
+            cached = self._encoded.get(patient_id)
+            if cached is None:
+                record = self._patients.get(patient_id)
+                if record is None:
+                    return None
+                body = encode_json(record)
+                cached = self._encoded[patient_id] = (body, etag(body))
+            return cached
+
+    def encoded_all(self) -> Tuple[bytes, str]:
+        with self._reading():
+            if self._encoded_all is None:
+                body = encode_json(self._patients)
+                self._encoded_all = (body, etag(body))
+            return self._encoded_all
+
+    def verdict_counts(self) -> Dict[str, int]:
+        with self._reading():
+            return self._columns.verdict_counts()
+
+    def bmi_histogram(self, bins: int) -> dict:
+        with self._reading():
+            return self._columns.bmi_histogram(bins)
+
+    def city_stats(self, percentiles: Sequence[float]) -> Dict[str, dict]:
+        with self._reading():
+            return self._columns.city_stats(percentiles)
+
+    def iter_patients(self, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[List[dict]]:
+        """Yield batches of patients (with their ID) without copying the whole store"""
+        with self._reading():
+            patient_ids = list(self._patients)
+
+        for start in range(0, len(patient_ids), batch_size):
+            with self._reading():
+                batch = []
+                for patient_id in patient_ids[start:start + batch_size]:
+                    record = self._patients.get(patient_id)
+                    # deleted since the stream started
+                    if record is not None:
+                        batch.append({'id': patient_id, **record})
+            yield batch
+
+    def create(self, patient_id: str, record: dict) -> bool:
+        """Add a patient, returns False if the ID is already taken"""
+        with self._writing():
+            if patient_id in self._patients:
+                return False
+            self._commit([{'op': 'put', 'id': patient_id, 'record': record}])
+            return True
+
+    def update(self, patient_id: str, change: Callable[[dict], dict]) -> Optional[dict]:
+        """Replace a patient with change(current record), returns None if it doesn't exist
+
+        change runs under the write lock, so concurrent edits of the same
+        patient are applied one after the other instead of overwriting each other.
+        """
+        with self._writing():
+            existing = self._patients.get(patient_id)
+            if existing is None:
+                return None
+            record = change(existing)
+            self._commit([{'op': 'put', 'id': patient_id, 'record': record}])
+            return record
+
+    def create_many(self, records: Dict[str, dict]) -> Dict[str, str]:
+        """Add several patients in one commit, returns {patient_id: error} for the ones skipped"""
+        with self._writing():
+            errors = {pid: 'Patient already exists' for pid in records if pid in self._patients}
+            self._commit([{'op': 'put', 'id': pid, 'record': record}
+                          for pid, record in records.items() if pid not in errors])
+            return errors
+
+    def update_many(self, changes: List[Tuple[str, Callable[[dict], dict]]]) -> Dict[str, Union[str, ValueError]]:
+        """Apply several update() style changes in one commit, returns {patient_id: error} for the ones skipped
+
+        A patient's changes are all applied or, if any of them fails, none are.
+        The error is 'Patient not found' or the ValueError the change raised.
+        """
+        with self._writing():
+            errors = {}
+            updated = {}
+            for patient_id, change in changes:
+                if patient_id in errors:
+                    continue
+                # later changes to the same patient build on the earlier ones in the batch
+                existing = updated.get(patient_id) or self._patients.get(patient_id)
+                if existing is None:
+                    errors[patient_id] = 'Patient not found'
+                    continue
+                try:
+                    updated[patient_id] = change(existing)
+                except ValueError as e:
+                    errors[patient_id] = e
+                    updated.pop(patient_id, None)
+
+            self._commit([{'op': 'put', 'id': pid, 'record': record} for pid, record in updated.items()])
+            return errors
+
+    def delete_many(self, patient_ids: List[str]) -> Dict[str, str]:
+        """Remove several patients in one commit, returns {patient_id: error} for the ones skipped"""
+        with self._writing():
+            errors = {pid: 'Patient not found' for pid in patient_ids if pid not in self._patients}
+            self._commit([{'op': 'delete', 'id': pid} for pid in dict.fromkeys(patient_ids) if pid not in errors])
+            return errors
+
+    def delete(self, patient_id: str) -> bool:
+        """Remove a patient, returns False if it doesn't exist"""
+        with self._writing():
+            if patient_id not in self._patients:
+                return False
+            self._commit([{'op': 'delete', 'id': patient_id}])
+            return True
@@ -1,11 +1,25 @@
-from fastapi import FastAPI, Path, HTTPException, Query
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, computed_field
-from typing import Annotated, Literal, Optional
-import json
+from fastapi import FastAPI, Path, HTTPException, Query, Body, Header
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, computed_field
+from typing import Annotated, List, Literal, Optional
+from patient_store import PatientRepository, SORT_FIELDS
+from http_cache import cached_json_response
+import os
 
 app = FastAPI()
 
+# storage backend, PATIENT_STORE=json (default) or sqlite
+PATIENT_STORE = os.getenv('PATIENT_STORE', 'json')
+
+if PATIENT_STORE == 'sqlite':
+    # import an existing file first with: python patient_sqlite.py migrate patients.json patients.db
+    from patient_sqlite import SQLitePatientRepository
+    repository = SQLitePatientRepository(os.getenv('PATIENT_DB', 'patients.db'))
+else:
+    # loaded once at startup, reloaded only when the file changes on disk;
+    # writes are appended to patients.json.log and compacted periodically
+    repository = PatientRepository('patients.json', journal=True)
+
 class Patient(BaseModel):
 
     id: Annotated[str, Field(..., description='ID of the patient', examples=['P001'])]
@@ -43,17 +57,52 @@ class PatientUpdate(BaseModel):
     height: Annotated[Optional[float], Field(default=None, gt=0)]
     weight: Annotated[Optional[float], Field(default=None, gt=0)]
 
+class PatientBatchUpdate(PatientUpdate):
+    id: Annotated[str, Field(..., description='ID of the patient to update', examples=['P001'])]
 
-def load_data():
-    with open('patients.json', 'r') as f:
-        data = json.load(f)
 
-    return data
+# validate a whole batch in one pass instead of one model at a time
+patient_list_adapter = TypeAdapter(List[Patient])
+patient_update_list_adapter = TypeAdapter(List[PatientBatchUpdate])
+
+
+def validate_batch(adapter: TypeAdapter, items: list):
+    try:
+        return adapter.validate_python(items)
+    except ValidationError as e:
+        # group the errors by the position of the item in the batch
+        errors = {}
+        for error in e.errors(include_url=False):
+            index, *loc = error['loc']
+            errors.setdefault(index, []).append({'loc': loc, 'msg': error['msg']})
+        raise HTTPException(status_code=422, detail=[{'index': index, 'errors': item_errors} for index, item_errors in sorted(errors.items())])
+
+
+def error_detail(error) -> object:
+    # validation errors in the same {'loc', 'msg'} shape validate_batch returns
+    if isinstance(error, ValidationError):
+        return [{'loc': list(item['loc']), 'msg': item['msg']} for item in error.errors(include_url=False)]
+    return str(error)
+
+
+def merge_patient_update(patient_id: str, updated_patient_info: dict):
+
+    # runs under the store's write lock against the latest version of the patient
+    def apply_update(existing_patient_info):
+        # work on a copy so a failed validation leaves the stored record untouched
+        existing_patient_info = dict(existing_patient_info)
+
+        for key, value in updated_patient_info.items():
+            existing_patient_info[key] = value
+
+        #existing_patient_info -> pydantic object -> updated bmi + verdict
+        existing_patient_info['id'] = patient_id
+        patient_pydandic_obj = Patient(**existing_patient_info)
+        #-> pydantic object -> dict
+        return patient_pydandic_obj.model_dump(exclude='id')
+
+    return apply_update
 
-def save_data(data):
-    with open('patients.json', 'w') as f:
-        json.dump(data, f)
-        
 
 @app.get("/")
 def hello():
@@ -64,24 +113,32 @@ def about():
     return {'message': 'A fully functional API to manage your patient records'}
 
 @app.get('/view')
-def view():
-    data = load_data()
+def view(format: Literal['json', 'ndjson', 'array'] = Query('json', description='json returns the whole dict, ndjson and array stream one patient at a time'),
+         if_none_match: Optional[str] = Header(None)):
+
+    if format == 'ndjson':
+        return StreamingResponse(repository.iter_ndjson(), media_type='application/x-ndjson')
+    if format == 'array':
+        return StreamingResponse(repository.iter_json_array(), media_type='application/json')
 
-    return data
+    # bytes are encoded once per version of the data, unchanged data answers 304
+    body, etag = repository.encoded_all()
+    return cached_json_response(body, etag, if_none_match)
 
 @app.get('/patient/{patient_id}')
-def view_patient(patient_id: str = Path(..., description='ID of the patient in the DB', example='P001')):
-    # load all the patients
-    data = load_data()
+def view_patient(patient_id: str = Path(..., description='ID of the patient in the DB', example='P001'), if_none_match: Optional[str] = Header(None)):
+    encoded = repository.encoded(patient_id)
 
-    if patient_id in data:
-        return data[patient_id]
+    if encoded is not None:
+        body, etag = encoded
+        return cached_json_response(body, etag, if_none_match)
     raise HTTPException(status_code=404, detail='Patient not found')
 
 @app.get('/sort')
-def sort_patients(sort_by: str = Query(..., description='Sort on the basis of height, weight or bmi'), order: str = Query('asc', description='sort in asc or desc order')):
+def sort_patients(sort_by: str = Query(..., description='Sort on the basis of height, weight or bmi'), order: str = Query('asc', description='sort in asc or desc order'),
+                  limit: Optional[int] = Query(None, ge=1, description='Maximum number of patients to return'), offset: int = Query(0, ge=0, description='Number of patients to skip')):
 
-    valid_fields = ['height', 'weight', 'bmi']
+    valid_fields = SORT_FIELDS
 
     if sort_by not in valid_fields:
         raise HTTPException(status_code=400, detail=f'Invalid field select from {valid_fields}')
@@ -89,84 +146,111 @@ def sort_patients(sort_by: str = Query(..., description='Sort on the basis of he
     if order not in ['asc', 'desc']:
         raise HTTPException(status_code=400, detail='Invalid order select between asc and desc')
     
-    data = load_data()
-
     sort_order = True if order=='desc' else False
 
-    sorted_data = sorted(data.values(), key=lambda x: x.get(sort_by, 0), reverse=sort_order)
+    # slice over the precomputed sorted index instead of sorting every call
+    sorted_data = repository.sort(sort_by, descending=sort_order, offset=offset, limit=limit)
 
     return sorted_data
 
-@app.post('/create')
-def create_patient(patient: Patient):
+@app.get('/patients/search')
+def search_patients(city: Optional[str] = Query(None, description='Exact city'), gender: Optional[Literal['male', 'female', 'others']] = Query(None, description='Gender of the patient'),
+                    verdict: Optional[str] = Query(None, description='BMI verdict, e.g. Obese'), min_age: Optional[int] = Query(None, ge=0, description='Minimum age (inclusive)'),
+                    max_age: Optional[int] = Query(None, ge=0, description='Maximum age (inclusive)'), limit: int = Query(50, ge=1, description='Maximum number of patients to return'),
+                    offset: int = Query(0, ge=0, description='Number of patients to skip')):
 
-    # load existing data
-    data = load_data()
+    filters = {field: value for field, value in (('city', city), ('gender', gender), ('verdict', verdict)) if value is not None}
 
-    # check if the patient already exists
-    if patient.id in data:
-        raise HTTPException(status_code=400, detail='Patient already exists')
+    count, patients = repository.search(filters, min_age=min_age, max_age=max_age, offset=offset, limit=limit)
 
-    # new patient add to the database
-    data[patient.id] = patient.model_dump(exclude=['id'])
+    return {'count': count, 'patients': patients}
 
-    # save into the json file
-    save_data(data)
+@app.get('/stats/verdicts')
+def verdict_stats():
+    counts = repository.verdict_counts()
 
-    return JSONResponse(status_code=201, content={'message':'patient created successfully'})
+    return {'total': sum(counts.values()), 'verdicts': counts}
 
+@app.get('/stats/bmi')
+def bmi_stats(bins: int = Query(10, ge=1, le=200, description='Number of equal width BMI buckets')):
+    return repository.bmi_histogram(bins)
 
-@app.put('/edit/{patient_id}')
-def update_patient(patient_id: str, patient_update: PatientUpdate):
+@app.get('/stats/cities')
+def city_stats(percentiles: List[float] = Query([50, 90, 99], description='Percentiles of age, height and weight to report per city')):
 
-    data = load_data()
+    if any(p < 0 or p > 100 for p in percentiles):
+        raise HTTPException(status_code=400, detail='Percentiles must be between 0 and 100')
 
-    if patient_id not in data:
-        raise HTTPException(status_code=404, detail='Patient not found')
-    
-    existing_patient_info = data[patient_id]
+    return repository.city_stats(percentiles)
 
-    updated_patient_info = patient_update.model_dump(exclude_unset=True)
+@app.post('/create')
+def create_patient(patient: Patient):
 
-    for key, value in updated_patient_info.items():
-        existing_patient_info[key] = value
+    # existence check and insert happen under one lock, so two creates with the same ID can't both pass
+    if not repository.create(patient.id, patient.model_dump(exclude=['id'])):
+        raise HTTPException(status_code=400, detail='Patient already exists')
+
+    return JSONResponse(status_code=201, content={'message':'patient created successfully'})
 
-    #existing_patient_info -> pydantic object -> updated bmi + verdict
-    existing_patient_info['id'] = patient_id
-    patient_pydandic_obj = Patient(**existing_patient_info)
-    #-> pydantic object -> dict
-    existing_patient_info = patient_pydandic_obj.model_dump(exclude='id')
 
-    # add this dict to data
-    data[patient_id] = existing_patient_info
+@app.put('/edit/{patient_id}')
+def update_patient(patient_id: str, patient_update: PatientUpdate):
+
+    updated_patient_info = patient_update.model_dump(exclude_unset=True)
 
-    # save data
-    save_data(data)
+    if repository.update(patient_id, merge_patient_update(patient_id, updated_patient_info)) is None:
+        raise HTTPException(status_code=404, detail='Patient not found')
 
     return JSONResponse(status_code=200, content={'message':'patient updated'})
 
 @app.delete('/delete/{patient_id}')
 def delete_patient(patient_id: str):
 
-    # load data
-    data = load_data()
-
-    if patient_id not in data:
+    if not repository.delete(patient_id):
         raise HTTPException(status_code=404, detail='Patient not found')
-    
-    del data[patient_id]
-
-    save_data(data)
 
     return JSONResponse(status_code=200, content={'message':'patient deleted'})
 
 
+@app.post('/patients/batch')
+def create_patients(patients: List[dict] = Body(..., description='Patients to create')):
+
+    patients = validate_batch(patient_list_adapter, patients)
+
+    records = {}
+    errors = []
+    for patient in patients:
+        if patient.id in records:
+            errors.append({'id': patient.id, 'detail': 'Duplicate ID in batch'})
+            continue
+        records[patient.id] = patient.model_dump(exclude=['id'])
+
+    # one storage commit for the whole batch
+    skipped = repository.create_many(records)
+    errors.extend({'id': patient_id, 'detail': detail} for patient_id, detail in skipped.items())
+
+    return JSONResponse(status_code=201, content={'message': 'patients created', 'created': len(records) - len(skipped), 'errors': errors})
 
 
+@app.put('/patients/batch')
+def update_patients(patient_updates: List[dict] = Body(..., description='Partial updates, each with the id of the patient')):
 
+    patient_updates = validate_batch(patient_update_list_adapter, patient_updates)
 
+    changes = [
+        (update.id, merge_patient_update(update.id, update.model_dump(exclude_unset=True, exclude={'id'})))
+        for update in patient_updates
+    ]
+    skipped = repository.update_many(changes)
+    errors = [{'id': patient_id, 'detail': error_detail(error)} for patient_id, error in skipped.items()]
 
+    return JSONResponse(status_code=200, content={'message': 'patients updated', 'updated': len({pid for pid, _ in changes} - set(skipped)), 'errors': errors})
 
 
+@app.delete('/patients/batch')
+def delete_patients(patient_ids: List[str] = Body(..., description='IDs of the patients to delete')):
 
+    skipped = repository.delete_many(patient_ids)
+    errors = [{'id': patient_id, 'detail': detail} for patient_id, detail in skipped.items()]
 
+    return JSONResponse(status_code=200, content={'message': 'patients deleted', 'deleted': len(set(patient_ids) - set(skipped)), 'errors': errors})
@@ -1,38 +1,49 @@
-from fastapi import FastAPI, Path, HTTPException, Query
-import json
+from fastapi import FastAPI, Path, HTTPException, Query, Header
+from fastapi.responses import StreamingResponse
+from typing import Literal, Optional
+from patient_store import PatientRepository, SORT_FIELDS
+from http_cache import cached_json_response
 
-def load_data():
-    try:
-        with open("patient.json", 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="patient.json file not found")
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON in patient.json")
+repository = PatientRepository("patient.json")
 
 
 app = FastAPI()
 
 
 @app.get("/view")
-def view():
-    return load_data()
+def view(
+    format: Literal['json', 'ndjson', 'array'] = Query("json", description="json returns the whole dict, ndjson and array stream one patient at a time"),
+    if_none_match: Optional[str] = Header(None)
+):
+    if format == 'ndjson':
+        return StreamingResponse(repository.iter_ndjson(), media_type="application/x-ndjson")
+    if format == 'array':
+        return StreamingResponse(repository.iter_json_array(), media_type="application/json")
+
+    body, etag = repository.encoded_all()
+    return cached_json_response(body, etag, if_none_match)
 
 
 @app.get('/patient/{patient_id}')
-def view_patient(patient_id: str = Path(..., description='id of patient in database', example='P001')):
-    data = load_data()
-    if patient_id in data:
-        return data[patient_id]
+def view_patient(
+    patient_id: str = Path(..., description='id of patient in database', example='P001'),
+    if_none_match: Optional[str] = Header(None)
+):
+    encoded = repository.encoded(patient_id)
+    if encoded is not None:
+        body, etag = encoded
+        return cached_json_response(body, etag, if_none_match)
     raise HTTPException(status_code=404, detail='Patient not found')
 
 
 @app.get('/sort')
 def sort_patients(
     sort_by: str = Query(..., description="Sort on the basis of height, weight or bmi"),
-    order: str = Query("asc", description="sort in asc or desc order")
+    order: str = Query("asc", description="sort in asc or desc order"),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of patients to return"),
+    offset: int = Query(0, ge=0, description="Number of patients to skip")
 ):
-    valid_fields = ['height', 'weight', 'bmi']
+    valid_fields = SORT_FIELDS
 
     if sort_by not in valid_fields:
         raise HTTPException(
@@ -46,12 +57,38 @@ def sort_patients(
             detail="Invalid order. Select between 'asc' and 'desc'"
         )
     
-    data = load_data()
+    sorted_data = repository.sort(
+        sort_by,
+        descending=(order == 'desc'),
+        offset=offset,
+        limit=limit
+    )
+
+    return sorted_data
+
+
+@app.get('/patients/search')
+def search_patients(
+    city: Optional[str] = Query(None, description="Exact city"),
+    gender: Optional[Literal['male', 'female', 'others']] = Query(None, description="Gender of the patient"),
+    verdict: Optional[str] = Query(None, description="BMI verdict, e.g. Obese"),
+    min_age: Optional[int] = Query(None, ge=0, description="Minimum age (inclusive)"),
+    max_age: Optional[int] = Query(None, ge=0, description="Maximum age (inclusive)"),
+    limit: int = Query(50, ge=1, description="Maximum number of patients to return"),
+    offset: int = Query(0, ge=0, description="Number of patients to skip")
+):
+    filters = {
+        field: value
+        for field, value in (('city', city), ('gender', gender), ('verdict', verdict))
+        if value is not None
+    }
 
-    sorted_data = sorted(
-        data.values(), 
-        key=lambda x: x.get(sort_by, 0), 
-        reverse=(order == 'desc')
+    count, patients = repository.search(
+        filters,
+        min_age=min_age,
+        max_age=max_age,
+        offset=offset,
+        limit=limit
     )
 
-    return sorted_data
\ No newline at end of file
+    return {"count": count, "patients": patients}
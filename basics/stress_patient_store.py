@@ -0,0 +1,63 @@
+"""Concurrent write stress test for the patient stores
+
+Fires thousands of creates (and read-modify-write updates of one patient)
+from a thread pool, like FastAPI's threadpool running the sync routes, then
+reloads each store from disk and checks that no write was lost:
+
+    python stress_patient_store.py [creates] [threads]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from patient_sqlite import SQLitePatientRepository
+from patient_store import PatientRepository
+
+UPDATES = 1000
+
+
+def make_record(i: int) -> dict:
+    return {'name': f'Patient {i}', 'city': ['Delhi', 'Mumbai', 'Pune'][i % 3], 'age': 20 + i % 60,
+            'gender': 'female' if i % 2 else 'male', 'height': 1.5 + i % 40 / 100, 'weight': 50 + i % 50,
+            'bmi': 22.5, 'verdict': 'Normal'}
+
+
+def bump_age(record: dict) -> dict:
+    return {**record, 'age': record['age'] + 1}
+
+
+def stress(name: str, open_store, creates: int, threads: int):
+    store = open_store()
+    store.create('counter', {**make_record(0), 'age': 0})
+    patient_ids = [f'S{i:06d}' for i in range(creates)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        created = pool.map(lambda i: store.create(patient_ids[i], make_record(i)), range(creates))
+        updated = pool.map(lambda _: store.update('counter', bump_age), range(UPDATES))
+        assert all(created), 'a create reported the ID as taken'
+        assert all(record is not None for record in updated), 'an update lost the patient'
+    elapsed = time.perf_counter() - start
+
+    # a fresh instance only sees what made it to disk
+    reloaded = open_store()
+    assert len(reloaded) == creates + 1, f'{name}: expected {creates + 1} patients, found {len(reloaded)}'
+    missing = [pid for pid in patient_ids if pid not in reloaded]
+    assert not missing, f'{name}: {len(missing)} creates lost, e.g. {missing[:5]}'
+    age = reloaded.get('counter')['age']
+    assert age == UPDATES, f'{name}: {UPDATES - age} of {UPDATES} updates lost'
+    print(f'{name:<16}{creates} creates + {UPDATES} updates on {threads} threads in {elapsed:.2f}s, none lost')
+
+
+if __name__ == '__main__':
+    creates = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'patients.json')
+        journal_path = os.path.join(tmp, 'journal.json')
+        db_path = os.path.join(tmp, 'patients.db')
+        # without the journal every write rewrites the whole file, so it gets a tenth of the creates
+        stress('json', lambda: PatientRepository(json_path), creates // 10, threads)
+        stress('json journal', lambda: PatientRepository(journal_path, journal=True, compact_every=1000), creates, threads)
+        stress('sqlite', lambda: SQLitePatientRepository(db_path), creates, threads)
@@ -5,12 +5,13 @@ import json
 import uuid
 from typing import Optional
 import uvicorn
+from redis_pool import redis_pool
 
-# Initialize FastAPI app
-app = FastAPI(title="Redis FastAPI Demo", version="1.0.0")
+# Initialize FastAPI app, the lifespan opens and closes the shared Redis pool
+app = FastAPI(title="Redis FastAPI Demo", version="1.0.0", lifespan=redis_pool.lifespan)
 
-# Initialize Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Async Redis client from the shared pool
+redis_client = redis_pool.client
 
 # Pydantic models
 class User(BaseModel):
@@ -32,19 +33,27 @@ async def root():
 @app.get("/redis/ping")
 async def ping_redis():
     try:
-        response = redis_client.ping()
+        response = await redis_client.ping()
         return {"redis_status": "connected", "ping": response}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Redis connection failed: {str(e)}")
 
+# Ping latency and connection pool usage
+@app.get("/redis/health")
+async def redis_health():
+    try:
+        return await redis_pool.health()
+    except redis.RedisError as e:
+        raise HTTPException(status_code=503, detail=f"Redis unavailable: {str(e)}")
+
 # Set a key-value pair with optional TTL
 @app.post("/cache/set")
 async def set_cache(item: CacheItem):
     try:
         if item.ttl:
-            redis_client.setex(item.key, item.ttl, item.value)
+            await redis_client.setex(item.key, item.ttl, item.value)
         else:
-            redis_client.set(item.key, item.value)
+            await redis_client.set(item.key, item.value)
         return {"message": f"Key '{item.key}' set successfully", "ttl": item.ttl}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -53,10 +62,10 @@ async def set_cache(item: CacheItem):
 @app.get("/cache/get/{key}")
 async def get_cache(key: str):
     try:
-        value = redis_client.get(key)
+        value = await redis_client.get(key)
         if value is None:
             raise HTTPException(status_code=404, detail="Key not found")
-        return {"key": key, "value": value, "ttl": redis_client.ttl(key)}
+        return {"key": key, "value": value, "ttl": await redis_client.ttl(key)}
     except redis.RedisError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -64,7 +73,7 @@ async def get_cache(key: str):
 @app.delete("/cache/delete/{key}")
 async def delete_cache(key: str):
     try:
-        result = redis_client.delete(key)
+        result = await redis_client.delete(key)
         if result == 0:
             raise HTTPException(status_code=404, detail="Key not found")
         return {"message": f"Key '{key}' deleted successfully"}
@@ -0,0 +1,409 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import math
+import os
+import random
+import struct
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from redis_pool import redis_pool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# json always works, orjson and msgpack when installed
+CACHE_SERIALIZER = os.getenv("CACHE_SERIALIZER", "json")
+# entries kept in each worker's memory per cached function
+CACHE_LOCAL_MAXSIZE = int(os.getenv("CACHE_LOCAL_MAXSIZE", "1024"))
+# seconds a worker trusts its local copy before checking Redis again. invalidate()
+# only reaches other workers through Redis, so this bounds how long they can serve a purged value
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "5"))
+# invalidation counters only need to outlive the longest recompute
+TAG_VERSION_TTL = 3600
+# how often a worker waiting on another worker's recompute checks for the result
+LOCK_POLL_INTERVAL = 0.05
+
+# each Redis value is this header (fresh until, seconds the recompute took) then the payload
+HEADER = struct.Struct("!dd")
+
+# only the lock's owner may release it, an expired lock may already belong to someone else
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: the cache key, then n tag sets, then their n version counters
+# ARGV: payload, ttl in ms, then the versions read before computing
+# a tag invalidated since then means the value may predate the change, so it isn't stored
+STORE_TAGGED = """
+local n = (#KEYS - 1) / 2
+for i = 1, n do
+    if (redis.call('GET', KEYS[1 + n + i]) or '') ~= ARGV[2 + i] then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+for i = 1, n do
+    redis.call('SADD', KEYS[1 + i], KEYS[1])
+    if redis.call('PTTL', KEYS[1 + i]) < tonumber(ARGV[2]) then
+        redis.call('PEXPIRE', KEYS[1 + i], ARGV[2])
+    end
+end
+return 1
+"""
+
+# KEYS: n tag sets, then their n version counters. returns the deleted cache keys
+INVALIDATE = """
+local n = #KEYS / 2
+local deleted = {}
+for i = 1, n do
+    local keys = redis.call('SMEMBERS', KEYS[i])
+    for j = 1, #keys, 1000 do
+        redis.call('DEL', unpack(keys, j, math.min(j + 999, #keys)))
+    end
+    for _, key in ipairs(keys) do
+        table.insert(deleted, key)
+    end
+    redis.call('DEL', KEYS[i])
+    redis.call('INCR', KEYS[n + i])
+    redis.call('PEXPIRE', KEYS[n + i], ARGV[1])
+end
+return deleted
+"""
+
+# every cache in this process, so invalidate() can drop local copies too
+_caches: List["TwoTierCache"] = []
+# bumped by every invalidate() in this process. a value read from Redis or computed
+# before an invalidate finished may already be purged, so it isn't put in a local LRU
+_invalidations = 0
+_invalidate = redis_pool.binary_client.register_script(INVALIDATE)
+
+
+def tag_key(tag: str) -> str:
+    return f"cache:tag:{tag}"
+
+
+def tag_version_key(tag: str) -> str:
+    return f"cache:tagver:{tag}"
+
+
+def _json_dumps(value) -> bytes:
+    return json.dumps(value, default=str).encode()
+
+
+SERIALIZERS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {"json": (_json_dumps, json.loads)}
+if orjson is not None:
+    SERIALIZERS["orjson"] = (lambda value: orjson.dumps(value, default=str), orjson.loads)
+if msgpack is not None:
+    SERIALIZERS["msgpack"] = (lambda value: msgpack.packb(value, default=str), msgpack.unpackb)
+
+
+def register_serializer(name: str, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]):
+    SERIALIZERS[name] = (dumps, loads)
+
+
+def get_serializer(name: str):
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown or not installed cache serializer: {name}")
+    return SERIALIZERS[name]
+
+
+def make_key_builder(func) -> Callable[..., str]:
+    """Key function for func, the same call gives the same key however its arguments are passed"""
+    signature = inspect.signature(func)
+    prefix = f"cache:{func.__module__}.{func.__qualname__}"
+    if not signature.parameters:
+        return lambda *args, **kwargs: prefix
+
+    def build(*args, **kwargs) -> str:
+        # bind so f(1), f(n=1) and f() with a default of 1 share a key
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        raw = json.dumps(bound.arguments, sort_keys=True, separators=(",", ":"), default=repr)
+        return f"{prefix}:{hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()}"
+
+    return build
+
+
+class Entry(NamedTuple):
+    value: Any
+    expires_at: float  # fresh until, wall clock so every worker agrees
+    stale_until: float  # still served, while one caller refreshes it, until this
+    delta: float  # seconds the last recompute took, drives early expiry
+
+
+class LocalLRU:
+    """Bounded in-process map with a per-entry TTL, the least recently used entry is dropped first"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Entry, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Entry]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        entry, local_until = item
+        if time.monotonic() >= local_until:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: Entry):
+        self._entries[key] = (entry, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: str):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache:
+    """Results of one async function, in a local LRU in front of Redis
+
+    Concurrent misses on a key share one computation in this process, and a
+    Redis lock makes the other workers wait for it instead of recomputing.
+    Values are returned as-is from the local tier, callers shouldn't mutate them.
+    """
+
+    def __init__(self, func, expiration: int, stale_ttl: int, beta: float, local_maxsize: int, local_ttl: float,
+                 serializer: str, lock_timeout: float, tags: Sequence[str], none_ttl: Optional[int] = None):
+        self.func = func
+        self.expiration = expiration
+        self.none_ttl = expiration if none_ttl is None else none_ttl
+        self.stale_ttl = stale_ttl
+        self.beta = beta
+        self.lock_timeout = lock_timeout
+        self.tags = tags
+        self.signature = inspect.signature(func)
+        self.key = make_key_builder(func)
+        self.dumps, self.loads = get_serializer(serializer)
+        self.local = LocalLRU(local_maxsize, local_ttl)
+        self.redis = redis_pool.binary_client
+        self._release_lock = self.redis.register_script(RELEASE_LOCK)
+        self._store_tagged = self.redis.register_script(STORE_TAGGED)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = dict.fromkeys(("local_hits", "redis_hits", "stale_hits", "early_refreshes", "misses",
+                                    "coalesced", "computes"), 0)
+        _caches.append(self)
+
+    async def get(self, args, kwargs):
+        key = self.key(*args, **kwargs)
+        now = time.time()
+        entry = self.local.get(key)
+        if entry is not None and now < entry.expires_at:
+            self.stats["local_hits"] += 1
+        else:
+            # another worker may have refreshed it
+            generation = _invalidations
+            entry = await self._load(key)
+            if entry is not None:
+                self._set_local(key, entry, generation)
+                self.stats["redis_hits"] += 1
+
+        if entry is None or now >= entry.stale_until:
+            self.stats["misses"] += 1
+            return await asyncio.shield(self._start(key, args, kwargs, entry))
+
+        if now >= entry.expires_at:
+            self.stats["stale_hits"] += 1
+            self._start(key, args, kwargs, entry)
+        elif self._expires_early(entry, now):
+            self.stats["early_refreshes"] += 1
+            self._start(key, args, kwargs, entry)
+        return entry.value
+
+    def _expires_early(self, entry: Entry, now: float) -> bool:
+        # XFetch: refresh before expiry with a probability that rises as expiry
+        # nears and with how long the recompute takes, so hot keys don't all expire at once
+        return self.beta > 0 and now - entry.delta * self.beta * math.log(1.0 - random.random()) >= entry.expires_at
+
+    def _start(self, key: str, args, kwargs, seen: Optional[Entry]) -> asyncio.Task:
+        # one recompute per key in this process, later callers join it
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            return task
+        task = asyncio.ensure_future(self._recompute(key, args, kwargs, seen))
+        self._inflight[key] = task
+        task.add_done_callback(functools.partial(self._finished, key))
+        return task
+
+    def _finished(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # background refreshes have no caller to raise to
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Cache refresh of {key} failed: {task.exception()!r}")
+
+    async def _recompute(self, key: str, args, kwargs, seen: Optional[Entry]):
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+        while not await self.redis.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)):
+            # another worker is computing it, take its result once it lands.
+            # if that worker dies its lock expires and we compute it ourselves.
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            generation = _invalidations
+            entry = await self._load(key)
+            if self._is_newer(entry, seen):
+                self._set_local(key, entry, generation)
+                return entry.value
+        try:
+            # the previous lock holder may have written it just before we got the lock
+            generation = _invalidations
+            entry = await self._load(key)
+            if self._is_newer(entry, seen):
+                self._set_local(key, entry, generation)
+                return entry.value
+            tags = self._tags(args, kwargs)
+            versions = await self.redis.mget([tag_version_key(tag) for tag in tags]) if tags else []
+            self.stats["computes"] += 1
+            start = time.perf_counter()
+            value = await self.func(*args, **kwargs)
+            await self._store(key, value, time.perf_counter() - start, tags, versions, generation)
+            return value
+        finally:
+            await self._release_lock(keys=[lock_key], args=[token])
+
+    @staticmethod
+    def _is_newer(entry: Optional[Entry], seen: Optional[Entry]) -> bool:
+        if entry is None or time.time() >= entry.expires_at:
+            return False
+        return seen is None or entry.expires_at > seen.expires_at
+
+    async def _load(self, key: str) -> Optional[Entry]:
+        raw = await self.redis.get(key)
+        if raw is None:
+            return None
+        expires_at, delta = HEADER.unpack_from(raw)
+        return Entry(self.loads(raw[HEADER.size:]), expires_at, expires_at + self.stale_ttl, delta)
+
+    def _tags(self, args, kwargs) -> List[str]:
+        # templates such as "user:{user_id}" filled in from the call's arguments
+        if not self.tags:
+            return []
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return [tag.format(**bound.arguments) for tag in self.tags]
+
+    def _set_local(self, key: str, entry: Entry, generation: int):
+        # an invalidate() since generation was read may have just popped this key
+        if generation == _invalidations:
+            self.local.set(key, entry)
+
+    async def _store(self, key: str, value, delta: float, tags: List[str], versions: List[Optional[bytes]],
+                     generation: int):
+        expiration = self.expiration if value is not None else self.none_ttl
+        if not expiration:
+            return
+        expires_at = time.time() + expiration
+        payload = HEADER.pack(expires_at, delta) + self.dumps(value)
+        # Redis keeps it through the stale window, after that it's a plain miss
+        ttl_ms = int((expiration + self.stale_ttl) * 1000)
+        if tags:
+            stored = await self._store_tagged(
+                keys=[key, *map(tag_key, tags), *map(tag_version_key, tags)],
+                args=[payload, ttl_ms, *(version or b"" for version in versions)],
+            )
+            if not stored:
+                return
+        else:
+            await self.redis.set(key, payload, px=ttl_ms)
+        self._set_local(key, Entry(value, expires_at, expires_at + self.stale_ttl, delta), generation)
+
+
+async def invalidate(*tags: str) -> int:
+    """Drop every cached result registered under any of the tags, returns how many were dropped
+
+    Redis entries go at once. Other workers' local copies live up to their local_ttl.
+    """
+    global _invalidations
+    if not tags:
+        return 0
+    # before the script runs, so reads already in flight don't refill the local LRUs
+    _invalidations += 1
+    deleted = await _invalidate(keys=[*map(tag_key, tags), *map(tag_version_key, tags)],
+                                args=[TAG_VERSION_TTL * 1000])
+    for key in deleted:
+        key = key.decode()
+        for cache in _caches:
+            cache.local.pop(key)
+    return len(deleted)
+
+
+def redis_cache(expiration: int = 3600, stale_ttl: int = 0, beta: float = 1.0,
+                local_maxsize: int = CACHE_LOCAL_MAXSIZE, local_ttl: float = CACHE_LOCAL_TTL,
+                serializer: str = CACHE_SERIALIZER, lock_timeout: float = 30.0, tags: Sequence[str] = (),
+                none_ttl: Optional[int] = None):
+    """Cache an async function's results in a local LRU and Redis
+
+    expiration: seconds a result is fresh
+    stale_ttl: seconds after that it's still served while one caller refreshes it
+    beta: eagerness of probabilistic early refresh, 0 turns it off
+    local_ttl: seconds a worker serves its local copy before checking Redis again
+    lock_timeout: seconds other workers wait on a recompute before trying themselves
+    tags: templates filled from the arguments, e.g. "user:{user_id}", for invalidate()
+    none_ttl: seconds a None result is fresh, expiration when omitted, 0 doesn't cache it
+    """
+    def decorator(func):
+        cache = TwoTierCache(func, expiration, stale_ttl, beta, local_maxsize, local_ttl, serializer,
+                             lock_timeout, tags, none_ttl)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await cache.get(args, kwargs)
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+async def benchmark(callers: int = 1000, workers: int = 4, compute_seconds: float = 0.2):
+    """A burst of callers on one cold key, spread over workers that share only Redis"""
+    computes = 0
+
+    async def expensive(n: int):
+        nonlocal computes
+        computes += 1
+        await asyncio.sleep(compute_seconds)
+        return {"n": n}
+
+    # separate caches stand in for separate worker processes
+    caches = [redis_cache(expiration=60)(expensive) for _ in range(workers)]
+    async with redis_pool.lifespan(None):
+        await redis_pool.binary_client.delete(caches[0].cache.key(1))
+        start = time.perf_counter()
+        await asyncio.gather(*(caches[i % workers](1) for i in range(callers)))
+        elapsed = time.perf_counter() - start
+        await redis_pool.binary_client.delete(caches[0].cache.key(1))
+    print(f"{callers} concurrent callers on one cold key, {workers} workers: "
+          f"{computes} recompute(s) in {elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        asyncio.run(benchmark())
+    else:
+        print("usage: python cache.py --bench")
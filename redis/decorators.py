@@ -1,45 +1,23 @@
-import functools
-import hashlib
+import asyncio
 import time
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI
 from pydantic import BaseModel
-import redis
-import json
 import uuid
 from typing import Optional
 import uvicorn
+from redis_pool import redis_pool
+from cache import redis_cache
 
-# Initialize FastAPI app
-app = FastAPI(title="Redis FastAPI Demo", version="1.0.0")
+# Initialize FastAPI app, the lifespan opens and closes the shared Redis pool
+app = FastAPI(title="Redis FastAPI Demo", version="1.0.0", lifespan=redis_pool.lifespan)
 
-# Initialize Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Async Redis client from the shared pool
+redis_client = redis_pool.client
 
 
-def redis_cache(expiration: int = 3600):
-    """Decorator to cache function results in Redis"""
-    def decorator(func):
-        @functools.wraps(func)
-        async def wrapper(*args, **kwargs):
-            # Create cache key from function name and arguments
-            cache_key = f"cache:{func.__name__}:{hashlib.md5(str(args + tuple(kwargs.items())).encode()).hexdigest()}"
-            
-            # Try to get cached result
-            cached_result = redis_client.get(cache_key)
-            if cached_result:
-                return json.loads(cached_result)
-            
-            # Execute function and cache result
-            result = await func(*args, **kwargs)
-            redis_client.setex(cache_key, expiration, json.dumps(result, default=str))
-            
-            return result
-        return wrapper
-    return decorator
-
 # Example of using the caching decorator
 @app.get("/expensive-operation/{n}")
-@redis_cache(expiration=300)  # Cache for 5 minutes
+@redis_cache(expiration=300, stale_ttl=60)  # Cache for 5 minutes, serve stale for 1 more while refreshing
 async def expensive_operation(n: int):
     """Simulate an expensive operation"""
     await asyncio.sleep(2)  # Simulate delay
@@ -50,3 +28,8 @@ async def expensive_operation(n: int):
         "computed_at": time.time(),
         "message": "This was computed (not cached)"
     }
+
+# Hit, miss and recompute counts of this worker's cache
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**expensive_operation.cache.stats, "local_entries": len(expensive_operation.cache.local)}
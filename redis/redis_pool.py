@@ -0,0 +1,143 @@
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+import redis.asyncio as redis
+
+# Shared by every app in this folder, each app process gets one pool
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+# requests beyond this many connections wait up to REDIS_POOL_TIMEOUT seconds for one.
+# the budget for the whole process, split between the text and binary pools
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+# how much of that budget the binary pool (the result cache) gets
+REDIS_BINARY_CONNECTION_SHARE = float(os.getenv("REDIS_BINARY_CONNECTION_SHARE", "0.5"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+# idle connections are PINGed before reuse after this many seconds
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+
+class RedisPool:
+    """A redis.asyncio client over a bounded connection pool, opened and closed by the app's lifespan"""
+
+    def __init__(self, host: str, port: int, db: int, max_connections: int, timeout: float, health_check_interval: int,
+                 binary_share: float = 0.5):
+        if max_connections < 2:
+            raise ValueError("max_connections must be at least 2, one for each pool")
+        pool_options = dict(
+            host=host,
+            port=port,
+            db=db,
+            timeout=timeout,
+            health_check_interval=health_check_interval,
+        )
+        # the two pools split max_connections, together they never open more
+        binary_connections = min(max(round(max_connections * binary_share), 1), max_connections - 1)
+        self.pool = redis.BlockingConnectionPool(**pool_options, max_connections=max_connections - binary_connections,
+                                                 decode_responses=True)
+        # connections are opened on first use, creating the client here doesn't touch the network
+        self.client = redis.Redis(connection_pool=self.pool)
+        # returns bytes as stored, for binary values such as the msgpack/orjson cache entries
+        self.binary_pool = redis.BlockingConnectionPool(**pool_options, max_connections=binary_connections)
+        self.binary_client = redis.Redis(connection_pool=self.binary_pool)
+
+    async def start(self):
+        # fail at startup rather than on the first request
+        await asyncio.gather(self.client.ping(), self.binary_client.ping())
+
+    async def close(self):
+        await self.client.aclose()
+        await self.pool.disconnect()
+        await self.binary_client.aclose()
+        await self.binary_pool.disconnect()
+
+    async def health(self) -> dict:
+        start = time.perf_counter()
+        await asyncio.gather(self.client.ping(), self.binary_client.ping())
+        pools = {name: {
+            "max_connections": pool.max_connections,
+            "in_use_connections": len(pool._in_use_connections),
+            "idle_connections": len(pool._available_connections),
+        } for name, pool in (("text", self.pool), ("binary", self.binary_pool))}
+        return {
+            "redis_status": "connected",
+            "ping_ms": round((time.perf_counter() - start) * 1000, 3),
+            # totals over both pools, then each pool
+            **{field: sum(stats[field] for stats in pools.values()) for field in pools["text"]},
+            "pools": pools,
+        }
+
+    @asynccontextmanager
+    async def lifespan(self, app):
+        await self.start()
+        try:
+            yield
+        finally:
+            await self.close()
+
+
+redis_pool = RedisPool(REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT,
+                       REDIS_HEALTH_CHECK_INTERVAL, REDIS_BINARY_CONNECTION_SHARE)
+
+
+async def _run(operation, requests: int, concurrency: int):
+    """Throughput of operation() and the worst event loop stall while it runs"""
+    lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal lag
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.perf_counter() - start - 0.001)
+
+    async def worker(count):
+        for i in range(count):
+            await operation(i)
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(requests // concurrency) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done = True
+    await tick
+    return requests / elapsed, lag
+
+
+async def benchmark(requests: int = 20000, concurrency: int = 0):
+    """SET+GET under concurrency, blocking client (what the apps did) vs the shared async pool"""
+    import redis as sync_redis
+
+    # twice as many tasks as the text pool has connections unless given
+    concurrency = concurrency or 2 * redis_pool.pool.max_connections
+
+    blocking = sync_redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+
+    async def blocking_op(i):
+        blocking.set(f"bench:{i}", i)
+        blocking.get(f"bench:{i}")
+
+    async def pooled_op(i):
+        await redis_pool.client.set(f"bench:{i}", i)
+        await redis_pool.client.get(f"bench:{i}")
+
+    async with redis_pool.lifespan(None):
+        print(f"{requests} SET+GET, {concurrency} concurrent tasks, {redis_pool.pool.max_connections} pooled connections")
+        print(f"{'client':<22}{'ops/s':>10}{'max loop stall':>17}")
+        for name, operation in (("blocking redis.Redis", blocking_op), ("pooled redis.asyncio", pooled_op)):
+            rate, lag = await _run(operation, requests, concurrency)
+            print(f"{name:<22}{rate:>10,.0f}{lag * 1000:>14.1f} ms")
+        keys = [key async for key in redis_pool.client.scan_iter("bench:*", count=1000)]
+        for i in range(0, len(keys), 1000):
+            await redis_pool.client.delete(*keys[i:i + 1000])
+    blocking.close()
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        asyncio.run(benchmark())
+    else:
+        print("usage: python redis_pool.py --bench")
@@ -1,16 +1,27 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import redis
 import json
+import os
 import uuid
-from typing import Optional
+from typing import AsyncIterator, List, Literal, Optional
 import uvicorn
+from redis_pool import redis_pool
+from cache import invalidate, redis_cache
+from user_store import USER_FETCH_BATCH, USERS_SET, EmailAlreadyRegistered, create_user_store
 
-# Initialize FastAPI app
-app = FastAPI(title="Redis FastAPI Demo", version="1.0.0")
+# Initialize FastAPI app, the lifespan opens and closes the shared Redis pool
+app = FastAPI(title="Redis FastAPI Demo", version="1.0.0", lifespan=redis_pool.lifespan)
 
-# Initialize Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Async Redis client from the shared pool
+redis_client = redis_pool.client
+
+# "json" keeps each user as one JSON string, "hash" as a Redis hash with one field per attribute
+USER_STORAGE = os.getenv("USER_STORAGE", "json")
+user_store = create_user_store(USER_STORAGE, redis_client)
+# reads are purged on every write, so they can be cached for long
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "3600"))
 
 # Pydantic models
 class User(BaseModel):
@@ -19,6 +30,11 @@ class User(BaseModel):
     email: str
     age: int
 
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    email: Optional[str] = None
+    age: Optional[int] = None
+
 class CacheItem(BaseModel):
     key: str
     value: str
@@ -27,10 +43,10 @@ class CacheItem(BaseModel):
 @app.get("/cache/get/{key}")
 async def get_cache(key: str):
     try:
-        value = redis_client.get(key)
+        value = await redis_client.get(key)
         if value is None:
             raise HTTPException(status_code=404, detail="Key not found")
-        return {"key": key, "value": value, "ttl": redis_client.ttl(key)}
+        return {"key": key, "value": value, "ttl": await redis_client.ttl(key)}
     except redis.RedisError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -38,68 +54,126 @@ async def get_cache(key: str):
 @app.post("/users/", response_model=User)
 async def create_user(user: User):
     try:
-        user_id = str(uuid.uuid4())
-        user.id = user_id
+        user.id = str(uuid.uuid4())
         
-        # Store user data as JSON
-        user_key = f"user:{user_id}"
-        redis_client.set(user_key, user.json())
-        
-        # Add user ID to a set for easy retrieval
-        redis_client.sadd("users", user_id)
+        # Store the user, add its id to the users set and claim its email in one script
+        await user_store.create(user.model_dump())
         
         return user
+    except EmailAlreadyRegistered:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Get user by email, one round trip through the email index
+@app.get("/users/by-email/{email}", response_model=User)
+async def get_user_by_email(email: str):
+    try:
+        user = await user_store.get_by_email(email)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Get user by ID
+# Cached read, update and delete invalidate the user:{id} tag.
+# unknown ids aren't cached, lookups of random ids would each leave an entry behind
+@redis_cache(expiration=USER_CACHE_TTL, tags=["user:{user_id}"], none_ttl=0)
+async def load_user(user_id: str, fields: Optional[List[str]] = None) -> Optional[dict]:
+    return await user_store.get(user_id, fields)
+
+# Get user by ID, ?fields=name&fields=email returns only those fields
 @app.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: str):
+async def get_user(user_id: str, fields: Optional[List[str]] = Query(None, description='Fields to return, all when omitted')):
     try:
-        user_key = f"user:{user_id}"
-        user_data = redis_client.get(user_key)
+        if fields:
+            unknown = [field for field in fields if field not in User.model_fields]
+            if unknown:
+                raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
         
-        if not user_data:
+        user = await load_user(user_id, fields)
+        
+        if user is None:
             raise HTTPException(status_code=404, detail="User not found")
         
-        return User.parse_raw(user_data)
+        if fields:
+            return JSONResponse(user)
+        return user
+    except HTTPException:
+        raise
     except json.JSONDecodeError:
         raise HTTPException(status_code=500, detail="Invalid user data")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def users_response(users_json: List[str], **extra) -> Response:
+    # the stored values are already User JSON, splice them in instead of parsing and re-encoding
+    fields = json.dumps({"count": len(users_json), **extra})
+    return Response('{"users":[' + ",".join(users_json) + "]," + fields[1:], media_type="application/json")
+
+async def iter_users_ndjson(cursor: int, count: int) -> AsyncIterator[str]:
+    # one SSCAN page and one batched read at a time, memory stays bounded by the page size
+    while True:
+        cursor, user_ids = await redis_client.sscan(USERS_SET, cursor=cursor, count=count)
+        users_json = await user_store.get_json_many(user_ids)
+        if users_json:
+            yield "\n".join(users_json) + "\n"
+        if cursor == 0:
+            break
+
 # Get all users
 @app.get("/users/")
-async def get_all_users():
+async def get_all_users(cursor: Optional[int] = Query(None, ge=0, description='SSCAN cursor, 0 for the first page. Omit to list every user'),
+                        count: int = Query(USER_FETCH_BATCH, ge=1, le=10000, description='Users per page, a hint for SSCAN'),
+                        format: Literal['json', 'ndjson'] = Query('json', description='ndjson streams one user per line')):
     try:
-        user_ids = redis_client.smembers("users")
-        users = []
-        
-        for user_id in user_ids:
-            user_key = f"user:{user_id}"
-            user_data = redis_client.get(user_key)
-            if user_data:
-                users.append(User.parse_raw(user_data))
-        
-        return {"users": users, "count": len(users)}
+        if format == 'ndjson':
+            return StreamingResponse(iter_users_ndjson(cursor or 0, count), media_type='application/x-ndjson')
+
+        if cursor is None:
+            user_ids = await redis_client.smembers(USERS_SET)
+            return users_response(await user_store.get_json_many(user_ids))
+
+        # one page, keep calling with next_cursor until it comes back 0.
+        # SSCAN can return a user twice if the set is resized between pages.
+        next_cursor, user_ids = await redis_client.sscan(USERS_SET, cursor=cursor, count=count)
+        return users_response(await user_store.get_json_many(user_ids), next_cursor=next_cursor)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Update user
+async def apply_update(user_id: str, changes: dict):
+    # existence check, email index and write happen in one script
+    try:
+        user = await user_store.update(user_id, changes)
+    except EmailAlreadyRegistered:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    await invalidate(f"user:{user_id}")
+    return user
+
+# Update user, replaces every field
 @app.put("/users/{user_id}", response_model=User)
 async def update_user(user_id: str, user_update: User):
     try:
-        user_key = f"user:{user_id}"
-        
-        # Check if user exists
-        if not redis_client.exists(user_key):
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        # Update user data
-        user_update.id = user_id
-        redis_client.set(user_key, user_update.json())
-        
-        return user_update
+        return await apply_update(user_id, user_update.model_dump(exclude={"id"}))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Partially update user, only the fields sent are written
+@app.patch("/users/{user_id}", response_model=User)
+async def patch_user(user_id: str, user_update: UserUpdate):
+    try:
+        changes = user_update.model_dump(exclude_unset=True, exclude_none=True)
+        if not changes:
+            raise HTTPException(status_code=400, detail="No fields to update")
+        return await apply_update(user_id, changes)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -107,15 +181,13 @@ async def update_user(user_id: str, user_update: User):
 @app.delete("/users/{user_id}")
 async def delete_user(user_id: str):
     try:
-        user_key = f"user:{user_id}"
-        
-        # Delete user data and remove from set
-        deleted = redis_client.delete(user_key)
-        redis_client.srem("users", user_id)
-        
-        if deleted == 0:
+        # Delete user data, remove it from the set and release its email in one script
+        if not await user_store.delete(user_id):
             raise HTTPException(status_code=404, detail="User not found")
+        await invalidate(f"user:{user_id}")
         
         return {"message": f"User {user_id} deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,292 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional
+
+# Users fetched per MGET/pipeline, each batch is one round trip
+USER_FETCH_BATCH = 500
+
+USERS_SET = "users"
+# email -> user id, kept consistent with the user records by the scripts below
+EMAIL_INDEX = "users:email"
+
+
+class EmailAlreadyRegistered(Exception):
+    """Another user already has this email"""
+
+
+def user_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+# Writes claim the email in the index first, so a taken email changes nothing
+CREATE_HASH = """
+if redis.call('HSETNX', KEYS[3], ARGV[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+"""
+
+CREATE_JSON = """
+if redis.call('HSETNX', KEYS[3], ARGV[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+"""
+
+# Returns -1 if the user doesn't exist, 0 if the new email is taken, else the updated user
+UPDATE_HASH = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if ARGV[2] ~= '' then
+    local old = redis.call('HGET', KEYS[1], 'email')
+    if old ~= ARGV[2] then
+        local owner = redis.call('HGET', KEYS[2], ARGV[2])
+        if owner and owner ~= ARGV[1] then
+            return 0
+        end
+        if old and redis.call('HGET', KEYS[2], old) == ARGV[1] then
+            redis.call('HDEL', KEYS[2], old)
+        end
+        redis.call('HSET', KEYS[2], ARGV[2], ARGV[1])
+    end
+end
+if #ARGV > 2 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+UPDATE_JSON = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return -1
+end
+local user = cjson.decode(raw)
+local changes = cjson.decode(ARGV[2])
+if changes.email and changes.email ~= user.email then
+    local owner = redis.call('HGET', KEYS[2], changes.email)
+    if owner and owner ~= ARGV[1] then
+        return 0
+    end
+    if user.email and redis.call('HGET', KEYS[2], user.email) == ARGV[1] then
+        redis.call('HDEL', KEYS[2], user.email)
+    end
+    redis.call('HSET', KEYS[2], changes.email, ARGV[1])
+end
+for field, value in pairs(changes) do
+    user[field] = value
+end
+local encoded = cjson.encode(user)
+redis.call('SET', KEYS[1], encoded)
+return encoded
+"""
+
+DELETE_HASH = """
+local email = redis.call('HGET', KEYS[1], 'email')
+if redis.call('DEL', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+if email and redis.call('HGET', KEYS[3], email) == ARGV[1] then
+    redis.call('HDEL', KEYS[3], email)
+end
+return 1
+"""
+
+DELETE_JSON = """
+local raw = redis.call('GET', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+if not raw then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+local email = cjson.decode(raw).email
+if email and redis.call('HGET', KEYS[3], email) == ARGV[1] then
+    redis.call('HDEL', KEYS[3], email)
+end
+return 1
+"""
+
+# Index lookup and record read in one round trip
+BY_EMAIL_HASH = """
+local user_id = redis.call('HGET', KEYS[1], ARGV[1])
+if not user_id then
+    return nil
+end
+return redis.call('HGETALL', 'user:' .. user_id)
+"""
+
+BY_EMAIL_JSON = """
+local user_id = redis.call('HGET', KEYS[1], ARGV[1])
+if not user_id then
+    return nil
+end
+return redis.call('GET', 'user:' .. user_id)
+"""
+
+
+class UserStore(ABC):
+    """Users in Redis, every write is one atomic script that also maintains the email index"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @abstractmethod
+    async def create(self, user: Dict):
+        """Store a new user, raises EmailAlreadyRegistered if the email is taken"""
+
+    @abstractmethod
+    async def get(self, user_id: str, fields: Optional[List[str]] = None) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def get_json_many(self, user_ids: Iterable[str]) -> List[str]:
+        """JSON of the given users, ids whose record is gone are skipped"""
+
+    @abstractmethod
+    async def get_by_email(self, email: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def update(self, user_id: str, changes: Dict) -> Optional[Dict]:
+        """Apply changes to some fields, None if the user doesn't exist"""
+
+    @abstractmethod
+    async def delete(self, user_id: str) -> bool:
+        ...
+
+
+class JSONUserStore(UserStore):
+    """Each user is one JSON string under user:{id}"""
+
+    def __init__(self, redis_client):
+        super().__init__(redis_client)
+        self._create = redis_client.register_script(CREATE_JSON)
+        self._update = redis_client.register_script(UPDATE_JSON)
+        self._delete = redis_client.register_script(DELETE_JSON)
+        self._by_email = redis_client.register_script(BY_EMAIL_JSON)
+
+    async def create(self, user: Dict):
+        created = await self._create(keys=[user_key(user["id"]), USERS_SET, EMAIL_INDEX],
+                                     args=[user["id"], user["email"], json.dumps(user)])
+        if not created:
+            raise EmailAlreadyRegistered(user["email"])
+
+    async def get(self, user_id: str, fields: Optional[List[str]] = None) -> Optional[Dict]:
+        user_data = await self.redis.get(user_key(user_id))
+        if not user_data:
+            return None
+        user = json.loads(user_data)
+        if fields:
+            return {field: user.get(field) for field in fields}
+        return user
+
+    async def get_json_many(self, user_ids: Iterable[str]) -> List[str]:
+        user_ids = list(user_ids)
+        users_json = []
+        for start in range(0, len(user_ids), USER_FETCH_BATCH):
+            keys = [user_key(user_id) for user_id in user_ids[start:start + USER_FETCH_BATCH]]
+            users_json.extend(user_data for user_data in await self.redis.mget(keys) if user_data)
+        return users_json
+
+    async def get_by_email(self, email: str) -> Optional[Dict]:
+        user_data = await self._by_email(keys=[EMAIL_INDEX], args=[email])
+        return json.loads(user_data) if user_data else None
+
+    async def update(self, user_id: str, changes: Dict) -> Optional[Dict]:
+        result = await self._update(keys=[user_key(user_id), EMAIL_INDEX], args=[user_id, json.dumps(changes)])
+        if result == -1:
+            return None
+        if result == 0:
+            raise EmailAlreadyRegistered(changes["email"])
+        return json.loads(result)
+
+    async def delete(self, user_id: str) -> bool:
+        return bool(await self._delete(keys=[user_key(user_id), USERS_SET, EMAIL_INDEX], args=[user_id]))
+
+
+class HashUserStore(UserStore):
+    """Each user is a Redis hash under user:{id}, one field per attribute
+
+    Fields can be read (HMGET) and written (HSET) on their own, so partial
+    reads and updates don't move the whole record.
+    """
+
+    def __init__(self, redis_client):
+        super().__init__(redis_client)
+        self._create = redis_client.register_script(CREATE_HASH)
+        self._update = redis_client.register_script(UPDATE_HASH)
+        self._delete = redis_client.register_script(DELETE_HASH)
+        self._by_email = redis_client.register_script(BY_EMAIL_HASH)
+
+    @staticmethod
+    def _flatten(values: Dict) -> List[str]:
+        pairs = []
+        for field, value in values.items():
+            pairs.extend((field, str(value)))
+        return pairs
+
+    @staticmethod
+    def _decode(values: Dict) -> Dict:
+        # hash fields come back as strings
+        if values.get("age") is not None:
+            values["age"] = int(values["age"])
+        return values
+
+    @classmethod
+    def _from_reply(cls, reply) -> Optional[Dict]:
+        # HGETALL from a script comes back as a flat [field, value, ...] list
+        if not reply:
+            return None
+        return cls._decode(dict(zip(reply[::2], reply[1::2])))
+
+    async def create(self, user: Dict):
+        created = await self._create(keys=[user_key(user["id"]), USERS_SET, EMAIL_INDEX],
+                                     args=[user["id"], user["email"], *self._flatten(user)])
+        if not created:
+            raise EmailAlreadyRegistered(user["email"])
+
+    async def get(self, user_id: str, fields: Optional[List[str]] = None) -> Optional[Dict]:
+        if fields:
+            values = await self.redis.hmget(user_key(user_id), fields)
+            if all(value is None for value in values):
+                return None
+            return self._decode(dict(zip(fields, values)))
+        user = await self.redis.hgetall(user_key(user_id))
+        return self._decode(user) if user else None
+
+    async def get_json_many(self, user_ids: Iterable[str]) -> List[str]:
+        user_ids = list(user_ids)
+        users_json = []
+        for start in range(0, len(user_ids), USER_FETCH_BATCH):
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in user_ids[start:start + USER_FETCH_BATCH]:
+                pipe.hgetall(user_key(user_id))
+            users_json.extend(json.dumps(self._decode(user)) for user in await pipe.execute() if user)
+        return users_json
+
+    async def get_by_email(self, email: str) -> Optional[Dict]:
+        return self._from_reply(await self._by_email(keys=[EMAIL_INDEX], args=[email]))
+
+    async def update(self, user_id: str, changes: Dict) -> Optional[Dict]:
+        result = await self._update(keys=[user_key(user_id), EMAIL_INDEX],
+                                    args=[user_id, changes.get("email", ""), *self._flatten(changes)])
+        if result == -1:
+            return None
+        if result == 0:
+            raise EmailAlreadyRegistered(changes["email"])
+        return self._from_reply(result)
+
+    async def delete(self, user_id: str) -> bool:
+        return bool(await self._delete(keys=[user_key(user_id), USERS_SET, EMAIL_INDEX], args=[user_id]))
+
+
+def create_user_store(storage: str, redis_client) -> UserStore:
+    if storage == "hash":
+        return HashUserStore(redis_client)
+    return JSONUserStore(redis_client)
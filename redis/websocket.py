@@ -1,4 +1,5 @@
 import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
@@ -7,12 +8,10 @@ import json
 import uuid
 from typing import Optional
 import uvicorn
+from redis_pool import redis_pool
 
-# Initialize FastAPI app
-app = FastAPI(title="Redis FastAPI Demo", version="1.0.0")
-
-# Initialize Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Async Redis client from the shared pool
+redis_client = redis_pool.client
 
 class ConnectionManager:
     def __init__(self):
@@ -34,6 +33,44 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# longest wait between attempts to resubscribe after Redis drops the connection
+SUBSCRIBER_MAX_BACKOFF = 30.0
+
+# Redis subscriber, runs in the background for the app's lifetime
+async def redis_subscriber():
+    backoff = 1.0
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe("chat")
+            backoff = 1.0
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    await manager.broadcast(message["data"])
+            error = "subscription ended"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            with suppress(Exception):
+                await pubsub.aclose()
+        # messages published until then are missed, pub/sub doesn't keep them
+        print(f"Redis subscriber stopped ({error}), resubscribing in {backoff:.0f}s")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, SUBSCRIBER_MAX_BACKOFF)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # open the shared Redis pool, then listen for chat messages until shutdown
+    async with redis_pool.lifespan(app):
+        subscriber = asyncio.create_task(redis_subscriber())
+        yield
+        subscriber.cancel()
+        with suppress(asyncio.CancelledError):
+            await subscriber
+
+# Initialize FastAPI app
+app = FastAPI(title="Redis FastAPI Demo", version="1.0.0", lifespan=lifespan)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
@@ -41,20 +78,11 @@ async def websocket_endpoint(websocket: WebSocket):
         while True:
             data = await websocket.receive_text()
             # Publish message to Redis
-            redis_client.publish("chat", data)
+            await redis_client.publish("chat", data)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
-# Redis subscriber (run this in background)
-async def redis_subscriber():
-    pubsub = redis_client.pubsub()
-    pubsub.subscribe("chat")
-    
-    for message in pubsub.listen():
-        if message["type"] == "message":
-            await manager.broadcast(message["data"])
-
 @app.post("/broadcast")
 async def broadcast_message(message: str):
-    redis_client.publish("chat", message)
+    await redis_client.publish("chat", message)
     return {"message": "Message broadcasted"}
\ No newline at end of file